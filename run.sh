@@ -8,11 +8,12 @@ NUM_SEGMENT=${4:-32}
 SUB=${5:-true}
 SUB_TIME=${6:-true}
 FRAME_TIME=${7:-true}
+FRAME_SOURCE=${8:-images}
 
 # Check if required arguments are provided
 if [ -z "$TASK_MODE" ] || [ -z "$MODEL_NAME" ] || [ -z "$MODEL_SIZE" ]; then
     echo "Error: Required arguments missing"
-    echo "Usage: $0 TASK_MODE MODEL_NAME MODEL_SIZE [NUM_SEGMENT] [SUB] [SUB_TIME] [FRAME_TIME]"
+    echo "Usage: $0 TASK_MODE MODEL_NAME MODEL_SIZE [NUM_SEGMENT] [SUB] [SUB_TIME] [FRAME_TIME] [FRAME_SOURCE]"
     exit 1
 fi
 
@@ -28,13 +29,15 @@ else
     METHOD="global"
 fi
 
-# Run extract_frames.py
-python ./run/extract_frames.py --method "$METHOD" --num_segment "$NUM_SEGMENT"
+# Run extract_frames.py (not needed when frames are decoded from the videos by run_api.py)
+if [ "$FRAME_SOURCE" != "video" ]; then
+    python ./run/extract_frames.py --method "$METHOD" --num_segment "$NUM_SEGMENT"
 
-# Check if extract_frames.py executed successfully
-if [ $? -ne 0 ]; then
-    echo "Error: extract_frames.py failed"
-    exit 1
+    # Check if extract_frames.py executed successfully
+    if [ $? -ne 0 ]; then
+        echo "Error: extract_frames.py failed"
+        exit 1
+    fi
 fi
 
 # Run run_api.py
@@ -45,7 +48,8 @@ python ./run/run_api.py \
     --num_segment "$NUM_SEGMENT" \
     --sub "$SUB" \
     --sub_time "$SUB_TIME" \
-    --frame_time "$FRAME_TIME"
+    --frame_time "$FRAME_TIME" \
+    --frame_source "$FRAME_SOURCE"
 
 # Check if run_api.py executed successfully
 if [ $? -ne 0 ]; then
@@ -0,0 +1,265 @@
+import os
+import csv
+import json
+import argparse
+
+import numpy as np
+from tqdm import tqdm
+
+from json_stream import iter_json_items
+from result_store import ResultStore, STEP_SEP
+
+TASK_MODES = ['long_acc', 'clue_acc', 'miou', 'open']
+
+IOU_THRESHOLDS = (0.1, 0.2, 0.3, 0.4, 0.5)
+
+# 视频时长分桶 (秒)
+DURATION_BINS = (600, 1200, 1800, 3600)
+
+GROUP_BYS = ('domain', 'sub_category', 'duration')
+
+
+def parse_result_key(result_key):
+    """
+    long_acc_gpt-4o_2024-08-06_32_True_True_True ->
+    {"task_mode": "long_acc", "model": "gpt-4o_2024-08-06", "num_segment": "32", "sub": "True", ...}
+    Parsed from the right, since model names may contain underscores. None for other keys.
+    """
+    if STEP_SEP in result_key:
+        return None
+    parts = result_key.rsplit('_', 4)
+    if len(parts) != 5:
+        return None
+    head, num_segment, sub, sub_time, frame_time = parts
+    for task_mode in sorted(TASK_MODES, key=len, reverse=True):
+        if head.startswith(task_mode + '_'):
+            return {"task_mode": task_mode, "model": head[len(task_mode) + 1:], "num_segment": num_segment,
+                    "sub": sub, "sub_time": sub_time, "frame_time": frame_time}
+    return None
+
+def get_config_key(parsed):
+    """Result keys of the same model and settings share a config key, e.g. to pair miou with long_acc."""
+    return "_".join([parsed["model"], parsed["num_segment"], parsed["sub"], parsed["sub_time"], parsed["frame_time"]])
+
+def get_duration_labels(bins):
+    edges = [0] + [int(edge) for edge in bins]
+    labels = [f"{edges[i] // 60}-{edges[i + 1] // 60}min" for i in range(len(edges) - 1)]
+    labels.append(f">={edges[-1] // 60}min")
+    return labels
+
+class QuestionTable:
+    """Per-question metadata as columns; row i is qids[i]. Labels are 'unknown' where the metadata is missing."""
+
+    def __init__(self, items, duration_bins=DURATION_BINS):
+        self.qids = np.array([str(item['qid']) for item in items])
+        self.row = {qid: i for i, qid in enumerate(self.qids.tolist())}
+        duration = np.array([item.get('duration', np.nan) for item in items], dtype=np.float64)
+        duration_labels = np.array(get_duration_labels(duration_bins))
+        self.columns = {
+            'domain': np.array([item.get('domain') or 'unknown' for item in items]),
+            'sub_category': np.array([item.get('sub_category') or 'unknown' for item in items]),
+            'duration': np.where(np.isnan(duration), 'unknown', duration_labels[np.digitize(np.nan_to_num(duration), duration_bins)]),
+        }
+
+    @classmethod
+    def from_bench(cls, bench_path, duration_bins=DURATION_BINS, qids=()):
+        """
+        Questions of the bench, plus every other qid in qids (e.g. all stored results):
+        the bench only supplies the group labels, it does not decide which results count.
+        """
+        items = []
+        if bench_path is not None and os.path.exists(bench_path):
+            items = list(iter_json_items(bench_path, ['qid', 'domain', 'sub_category', 'duration']))
+        else:
+            print(f"{bench_path} not found, every group is 'unknown'")
+        known = {str(item['qid']) for item in items}
+        items.extend({'qid': qid} for qid in sorted(set(map(str, qids)) - known))
+        return cls(items, duration_bins)
+
+    def __len__(self):
+        return len(self.qids)
+
+def load_results(store=None, anno_root=None):
+    """
+    All results in one pass, as {result_key: {qid: result}}.
+    Step results of open keys keep their full key (open_.../step_2).
+    The store is only read: annotations are not re-indexed and nothing is inserted.
+    """
+    results = {}
+
+    if store is not None:
+        for qid, result_key, _, result in store.iter_latest():
+            results.setdefault(result_key, {})[qid] = result
+        return results
+
+    for root, _, files in os.walk(anno_root):
+        for file in tqdm(files, desc="Processing files", unit="file"):
+            if not file.endswith('.json'):
+                continue
+            with open(os.path.join(root, file), 'r', encoding='utf-8') as f:
+                anno = json.load(f)
+            qid = str(anno["qid"])
+            for result_key, entry in anno.get("results", {}).items():
+                if "result" in entry:
+                    results.setdefault(result_key, {})[qid] = entry["result"]
+                for step in ("step_1", "step_2"):
+                    if step in entry:
+                        results.setdefault(f"{result_key}{STEP_SEP}{step}", {})[qid] = entry[step]["result"]
+    return results
+
+def get_result_qids(results):
+    return {qid for values in results.values() for qid in values}
+
+def to_column(questions, values, numeric=True):
+    """{qid: result} -> float column over questions, NaN where missing (or non-numeric)."""
+    column = np.full(len(questions), np.nan)
+    for qid, value in values.items():
+        row = questions.row.get(qid)
+        if row is None or value is None:
+            continue
+        if numeric:
+            try:
+                column[row] = float(value)
+            except (TypeError, ValueError):
+                continue
+        else:
+            column[row] = 1.0
+    return column
+
+def group_sums(codes, num_groups, values):
+    """Sum of values (n,) or (n, k) per group code."""
+    out = np.zeros((num_groups,) + values.shape[1:])
+    np.add.at(out, codes, values)
+    return out
+
+def compute_metrics(questions, results, thresholds=IOU_THRESHOLDS, group_bys=GROUP_BYS, result_keys=None):
+    """
+    Rows of metrics for every result key (or the given ones), overall and per group.
+    accuracy: long_acc / clue_acc, and open (share of step_2 judged correct);
+    miou and rec@iou_<th>: miou keys; acc@iou_<th>: long_acc answered correctly with the
+    miou result of the same config at or above th.
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    parsed = {result_key: parse_result_key(result_key) for result_key in results}
+    parsed = {result_key: p for result_key, p in parsed.items() if p is not None}
+    if result_keys is None:
+        result_keys = sorted(parsed)
+
+    miou_keys = {get_config_key(p): result_key for result_key, p in parsed.items() if p["task_mode"] == "miou"}
+
+    groupings = [('all', np.zeros(len(questions), dtype=np.int64), np.array(['all']))]
+    for group_by in group_bys:
+        labels, codes = np.unique(questions.columns[group_by], return_inverse=True)
+        groupings.append((group_by, codes, labels))
+
+    rows = []
+    for result_key in result_keys:
+        p = parse_result_key(result_key)
+        if p is None or result_key not in results:
+            print(f"skip {result_key}: no results or not a <task_mode>_<model>_<num_segment>_<sub>_<sub_time>_<frame_time> key")
+            continue
+
+        columns = {}
+        if p["task_mode"] == "open":
+            present = ~np.isnan(to_column(questions, results[result_key], numeric=False))
+            step_2 = to_column(questions, results.get(f"{result_key}{STEP_SEP}step_2", {}))
+            judged = present & ~np.isnan(step_2)
+            columns["accuracy"] = (judged, (step_2 == 1).astype(np.float64))
+        else:
+            value = to_column(questions, results[result_key])
+            present = ~np.isnan(value)
+            if p["task_mode"] == "miou":
+                columns["miou"] = (present, value)
+                hits = value[:, None] >= thresholds[None, :]
+                for i, th in enumerate(thresholds):
+                    columns[f"rec@iou_{th:g}"] = (present, hits[:, i].astype(np.float64))
+            else:
+                columns["accuracy"] = (present, (value == 1).astype(np.float64))
+
+            miou_key = miou_keys.get(get_config_key(p))
+            if p["task_mode"] == "long_acc" and miou_key is not None:
+                iou = to_column(questions, results[miou_key])
+                paired = present & ~np.isnan(iou)
+                hits = (value[:, None] == 1) & (iou[:, None] >= thresholds[None, :])
+                for i, th in enumerate(thresholds):
+                    columns[f"acc@iou_{th:g}"] = (paired, hits[:, i].astype(np.float64))
+
+        for group_by, codes, labels in groupings:
+            totals = group_sums(codes, len(labels), present.astype(np.float64))
+            metric_values = {}
+            for name, (mask, values) in columns.items():
+                counts = group_sums(codes, len(labels), mask.astype(np.float64))
+                sums = group_sums(codes, len(labels), np.where(mask, values, 0.0))
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    metric_values[name] = (sums / counts, counts)
+
+            for g, label in enumerate(labels.tolist()):
+                if totals[g] == 0:
+                    continue
+                row = {"result_key": result_key, "task_mode": p["task_mode"], "model": p["model"],
+                       "num_segment": p["num_segment"], "group_by": group_by, "group": label, "total": int(totals[g])}
+                for name, (means, counts) in metric_values.items():
+                    row[name] = float(means[g]) if counts[g] > 0 else None
+                for prefix in ("rec@iou", "acc@iou"):
+                    per_threshold = [row.get(f"{prefix}_{th:g}") for th in thresholds]
+                    if per_threshold and all(v is not None for v in per_threshold):
+                        row[prefix] = float(np.mean(per_threshold))
+                rows.append(row)
+
+    return rows
+
+def get_fieldnames(rows):
+    fieldnames = []
+    for row in rows:
+        for name in row:
+            if name not in fieldnames:
+                fieldnames.append(name)
+    return fieldnames
+
+def write_rows(rows, output_path):
+    if output_path.endswith('.json'):
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False, indent=4)
+    else:
+        with open(output_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=get_fieldnames(rows))
+            writer.writeheader()
+            writer.writerows(rows)
+
+def format_row(row):
+    return ", ".join(f"{name}: {value:.4f}" if isinstance(value, float) else f"{name}: {value}"
+                     for name, value in row.items() if name not in ("result_key", "task_mode", "model", "num_segment"))
+
+def main():
+    parser = argparse.ArgumentParser(description="aggregate results of every result key, overall and by domain/sub_category/duration")
+    parser.add_argument('--bench', type=str, default="./cgbench_mini.json", help="group labels (domain, sub_category, duration)")
+    parser.add_argument('--anno_root', type=str, default="./cg_annotations", help="read when --result_store is none")
+    parser.add_argument('--result_store', type=str, default="./cg_results.db",
+                        help='SQLite results database ("none": read results from the annotation jsons)')
+    parser.add_argument('--result_keys', type=str, nargs='+', default=None, help="default: every key found")
+    parser.add_argument('--thresholds', type=float, nargs='+', default=list(IOU_THRESHOLDS))
+    parser.add_argument('--group_by', type=str, nargs='*', default=list(GROUP_BYS), choices=list(GROUP_BYS))
+    parser.add_argument('--duration_bins', type=int, nargs='+', default=list(DURATION_BINS), help="bucket edges in seconds")
+    parser.add_argument('--output', type=str, default=None, help="write rows to .csv or .json")
+    args = parser.parse_args()
+
+    store = None
+    if args.result_store.lower() != "none" and os.path.exists(args.result_store):
+        store = ResultStore(args.result_store, read_only=True)
+
+    results = load_results(store, args.anno_root)
+    questions = QuestionTable.from_bench(args.bench, args.duration_bins, get_result_qids(results))
+    rows = compute_metrics(questions, results, args.thresholds, args.group_by, args.result_keys)
+
+    for row in rows:
+        if row["group_by"] == "all":
+            print(f"Result Key: {row['result_key']}")
+            print(format_row(row) + "\n")
+
+    if args.output:
+        write_rows(rows, args.output)
+        print(f"wrote {len(rows)} rows to {args.output}")
+
+if __name__ == '__main__':
+    main()
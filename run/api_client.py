@@ -0,0 +1,165 @@
+import time
+import random
+import threading
+import email.utils
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """
+    Token bucket over requests/min and tokens/min, shared by all workers.
+    A limit of 0 disables that bucket.
+    """
+
+    def __init__(self, rpm=0, tpm=0):
+        self._lock = threading.Lock()
+        self.configure(rpm, tpm)
+
+    def configure(self, rpm=0, tpm=0):
+        with self._lock:
+            self.rpm = rpm
+            self.tpm = tpm
+            self.request_tokens = float(rpm)
+            self.text_tokens = float(tpm)
+            self.updated = time.monotonic()
+            self.paused_until = 0.0
+
+    def reserve(self, tokens=0):
+        """Take capacity for one request now and return how long the caller has to wait before sending it."""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.updated = now
+
+            delay = max(0.0, self.paused_until - now)
+
+            if self.rpm > 0:
+                self.request_tokens = min(self.rpm, self.request_tokens + elapsed * self.rpm / 60.0) - 1
+                if self.request_tokens < 0:
+                    delay = max(delay, -self.request_tokens * 60.0 / self.rpm)
+
+            if self.tpm > 0:
+                cost = min(tokens, self.tpm)
+                self.text_tokens = min(self.tpm, self.text_tokens + elapsed * self.tpm / 60.0) - cost
+                if self.text_tokens < 0:
+                    delay = max(delay, -self.text_tokens * 60.0 / self.tpm)
+
+            return delay
+
+    def acquire(self, tokens=0):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Hold back every worker, e.g. after the server answered 429 with Retry-After."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class ByteBudget:
+    """
+    Global limit on the bytes of request payloads held in memory at once.
+    A payload larger than the whole budget is still let through when nothing else is held.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.cur_bytes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, num_bytes):
+        with self._cond:
+            while self.cur_bytes > 0 and self.cur_bytes + num_bytes > self.max_bytes:
+                self._cond.wait()
+            self.cur_bytes += num_bytes
+
+    def release(self, num_bytes):
+        with self._cond:
+            self.cur_bytes -= num_bytes
+            self._cond.notify_all()
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def get_retry_delay(attempt, retry_after=None, backoff_base=1.0, backoff_max=60.0):
+    """Full-jitter exponential backoff, never shorter than the server's Retry-After."""
+    delay = random.uniform(0, min(backoff_max, backoff_base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+def estimate_tokens(text, num_images, tokens_per_image=85):
+    """Rough prompt size for the tokens/min bucket; 'detail: low' images cost a fixed 85 tokens."""
+    return len(text) // 4 + num_images * tokens_per_image
+
+def get_response_content(result):
+    if 'choices' not in result or result['choices'] is None:
+        print("response fail")
+        return None
+    return result['choices'][0]['message']['content']
+
+class APIClient:
+    """Pooled keep-alive sessions (one per thread) with rate limiting and retry on 429/5xx."""
+
+    def __init__(self, rpm=0, tpm=0, max_retries=5, backoff_base=1.0, backoff_max=60.0, pool_size=4):
+        self.limiter = RateLimiter(rpm, tpm)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self._local = threading.local()
+
+    def configure(self, rpm=0, tpm=0, max_retries=5):
+        self.limiter.configure(rpm, tpm)
+        self.max_retries = max_retries
+
+    def get_session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+        return session
+
+    def post(self, url, headers, body, timeout=300, tokens=0):
+        """
+        POST the encoded json body with retries. Returns the last response (possibly an error status the caller
+        should check), or re-raises the last connection/timeout error.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(tokens)
+
+            retry_after = None
+            try:
+                response = self.get_session().post(url, headers=headers, data=body, timeout=timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                error = str(e)
+            else:
+                if response.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                    return response
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                error = f"HTTP {response.status_code}"
+
+            delay = get_retry_delay(attempt, retry_after, self.backoff_base, self.backoff_max)
+            if retry_after is not None:
+                self.limiter.pause(retry_after)
+            print(f"Request failed ({error}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            time.sleep(delay)
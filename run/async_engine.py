@@ -0,0 +1,104 @@
+import time
+import asyncio
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from tqdm import tqdm
+
+from api_client import RETRY_STATUS, parse_retry_after, get_retry_delay, get_response_content
+
+
+async def post_with_retry(session, client, url, headers, body, timeout, tokens):
+    """aiohttp counterpart of APIClient.post, sharing its rate limiter and retry policy."""
+    for attempt in range(client.max_retries + 1):
+        delay = client.limiter.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        retry_after = None
+        try:
+            async with session.post(url, headers=headers, data=body, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status not in RETRY_STATUS or attempt == client.max_retries:
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                error = f"HTTP {response.status}"
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == client.max_retries:
+                raise
+            error = repr(e)
+
+        delay = get_retry_delay(attempt, retry_after, client.backoff_base, client.backoff_max)
+        if retry_after is not None:
+            client.limiter.pause(retry_after)
+        print(f"Request failed ({error}), retry {attempt + 1}/{client.max_retries} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+async def async_send_request(session, client, url, headers, body, tokens):
+
+    info = {}
+
+    try:
+        start_time = time.time()
+        result = await post_with_retry(session, client, url, headers, body, 300, tokens)
+        info["latency"] = time.time() - start_time
+
+        print(result)
+
+        info["usage"] = result.get("usage")
+
+        return get_response_content(result), info
+
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        # ValueError: 200 但响应体不是 json, 与线程版一样记为失败的请求
+        print(f"Request failed: {e!r}")
+        return None, info
+
+
+async def process_file(args, json_file, session, client, url, headers, executor, prepare_request, finish_request, release_request):
+    loop = asyncio.get_running_loop()
+    try:
+        anno, request = await loop.run_in_executor(executor, prepare_request, args, json_file)
+        try:
+            if request["send"]:
+                request["response"], request["info"] = await async_send_request(
+                    session, client, url, headers, request["body"], request["tokens"])
+        finally:
+            release_request(request)
+        await loop.run_in_executor(executor, finish_request, args, anno, request, json_file)
+        return True
+    except Exception as e:
+        logging.error(f"Error processing {json_file}: {str(e)}")
+        logging.error(traceback.format_exc())
+        return False
+
+async def run_async_main(args, tasks, prepare_request, finish_request, release_request, url, headers, client):
+
+    connector = aiohttp.TCPConnector(limit=args.max_in_flight)
+    pending = iter(tasks)
+    counts = {"successful": 0, "failed": 0}
+
+    with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            with tqdm(total=len(tasks), desc="Processing files") as pbar:
+
+                # max_in_flight 个 worker 从同一个迭代器按需取任务, 请求体在发送前才构造
+                async def worker():
+                    for task_args, json_file in pending:
+                        success = await process_file(task_args, json_file, session, client, url, headers, executor,
+                                                     prepare_request, finish_request, release_request)
+                        counts["successful" if success else "failed"] += 1
+                        pbar.update(1)
+
+                await asyncio.gather(*[worker() for _ in range(args.max_in_flight)])
+
+    return counts["successful"], counts["failed"]
+
+def run_async(args, tasks, prepare_request, finish_request, release_request, url, headers, client):
+    """
+    Keep up to args.max_in_flight requests open from a single event loop over (task_args, json_file) tasks.
+    Frame loading, prompt building and result saving run in a thread pool of args.num_threads.
+    """
+    return asyncio.run(run_async_main(args, tasks, prepare_request, finish_request, release_request, url, headers, client))
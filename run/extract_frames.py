@@ -1,126 +1,340 @@
 import os
-import numpy as np
-import json
+import io
 import argparse
-import decord
+import numpy as np
 from PIL import Image
+import queue
+import threading
 import concurrent.futures
+from collections import defaultdict
 from tqdm import tqdm
 
+from frame_store import FramePack, get_pack_path, write_frame_pack
+from sampling import sample_global_batch, sample_clue_batch
+from frame_resize import get_resized_root, resize_frame_bytes
+from json_stream import iter_json_items
+from video_frames import open_video_reader
+from video_meta import load_video_meta
+from keyframes import (KEYFRAME_INDEX_PATH, load_keyframe_index, save_keyframe_index, get_cached_keyframes,
+                       get_video_stat, get_snap_root, snap_to_keyframes, plan_decode)
+
+
+def _read_sequential(vr, frame_indices, state):
+    # 只 seek 一次, 之后顺序解码, 跳过的帧不做格式转换
+    frames = []
+    for frame_idx in frame_indices:
+        if state.get('pos') is None:
+            vr.seek_accurate(frame_idx)
+        elif frame_idx > state['pos']:
+            vr.skip_frames(frame_idx - state['pos'])
+        frames.append(vr.next().asnumpy())
+        state['pos'] = frame_idx + 1
+    return frames
+
+def _decode_batches(vr, frame_indices, batch_size, frame_queue, stop_event, mode='seek'):
+    try:
+        state = {}
+        for start in range(0, len(frame_indices), batch_size):
+            if stop_event.is_set():
+                break
+            batch_indices = frame_indices[start:start + batch_size]
+            if mode == 'sequential':
+                frames = _read_sequential(vr, batch_indices, state)
+            else:
+                frames = vr.get_batch(batch_indices).asnumpy()
+            frame_queue.put((batch_indices, frames))
+    except Exception as e:
+        frame_queue.put(e)
+    finally:
+        frame_queue.put(None)
+
+def get_existing_frames(video_output_path, store):
+    if store == 'pack':
+        pack_path = get_pack_path(video_output_path)
+        if not os.path.exists(pack_path):
+            return set()
+        pack = FramePack(pack_path)
+        existing = set(pack.frame_indices())
+        pack.close()
+        return existing
+
+    # 一次 listdir 代替逐帧 exists
+    if not os.path.isdir(video_output_path):
+        return set()
+    return set(int(os.path.splitext(f)[0]) for f in os.listdir(video_output_path) if f.endswith('.jpg') and f[:-4].isdigit())
+
+def _decode_and_store(vr, targets, mode, batch_size, queue_size, store, video_output_path, resized_output_path,
+                      max_side, jpeg_quality, packed_frames, resized_frames):
+    """Decode the frames in targets ({source_idx: [frame_idx, ...]}) from vr and store each under its frame_idx."""
+    source_indices = sorted(targets)
+
+    # 按顺序分批解码, 避免反向 seek; 解码与编码之间用有界队列
+    frame_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    decoder = threading.Thread(target=_decode_batches, args=(vr, source_indices, batch_size, frame_queue, stop_event, mode), daemon=True)
+    decoder.start()
+
+    try:
+        while True:
+            item = frame_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            batch_indices, frames = item
+            for source_idx, frame in zip(batch_indices, frames):
+                image = Image.fromarray(frame)
+                byte_stream = io.BytesIO()
+                image.save(byte_stream, 'JPEG')
+                data = byte_stream.getvalue()
+                resized = None
+                if resized_output_path is not None:
+                    # 从存下的 jpg 缩小, 与 get_resized_frame 之后补做的结果逐字节相同
+                    resized = resize_frame_bytes(data, max_side, jpeg_quality)
+
+                for frame_idx in targets[source_idx]:
+                    if store == 'pack':
+                        packed_frames[frame_idx] = data
+                        if resized is not None:
+                            resized_frames[frame_idx] = resized
+                    else:
+                        with open(os.path.join(video_output_path, f"{frame_idx}.jpg"), 'wb') as f:
+                            f.write(data)
+                        if resized is not None:
+                            with open(os.path.join(resized_output_path, f"{frame_idx}.jpg"), 'wb') as f:
+                                f.write(resized)
+    finally:
+        stop_event.set()
+        # 排空队列, 让解码线程退出
+        while decoder.is_alive() or not frame_queue.empty():
+            try:
+                frame_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        decoder.join()
 
-def process_video_frame(video_uid, frame_indices, cg_videos_path, output_images_path):
+def process_video_frames(video_uid, frame_indices, cg_videos_path, output_images_path, batch_size=8, queue_size=2, store='jpg',
+                         max_side=0, jpeg_quality=75, keyframes=None, snap_frames=0):
+    """
+    Decode all requested frames of one video with a single VideoReader, in sequential order.
+    Decoding runs in a helper thread and hands batches to the JPEG encoder through a bounded
+    queue, so at most (queue_size + 2) * batch_size frames are held in memory.
+    With store='pack' the frames are written to cg_images/<video_uid>.pack instead of loose jpgs.
+    With max_side > 0 a resized copy of each frame is also written under get_resized_root.
+    Depending on the sampling density the frames are read with one seek and a sequential decode,
+    or with a seek per GOP. With snap_frames > 0 a frame within snap_frames of a keyframe is
+    stored with the keyframe's content, so output_images_path must then be a snap root.
+    Returns the video's keyframe indices (None if it was not opened).
+    """
     video_path = os.path.join(cg_videos_path, f"{video_uid}.mp4")
     video_output_path = os.path.join(output_images_path, video_uid)
-    os.makedirs(video_output_path, exist_ok=True)
+    resized_output_path = None
+    if max_side > 0:
+        resized_output_path = os.path.join(get_resized_root(output_images_path, max_side, jpeg_quality), video_uid)
 
+    existing = get_existing_frames(video_output_path, store)
+    resize_only = []
+    if resized_output_path is not None:
+        # 原图已有, 只缺缩小版: 从原图缩放, 不重新解码也不重写原图
+        existing_resized = get_existing_frames(resized_output_path, store)
+        resize_only = [frame_idx for frame_idx in frame_indices if frame_idx in existing and frame_idx not in existing_resized]
+    frame_indices = [frame_idx for frame_idx in frame_indices if frame_idx not in existing]
+    if not frame_indices and not resize_only:
+        return keyframes
 
-    vr = decord.VideoReader(video_path)
+    if store == 'jpg':
+        os.makedirs(video_output_path, exist_ok=True)
+    if resized_output_path is not None:
+        os.makedirs(resized_output_path if store == 'jpg' else os.path.dirname(resized_output_path), exist_ok=True)
 
+    packed_frames = {}
+    resized_frames = {}
+    store_args = (batch_size, queue_size, store, video_output_path, resized_output_path, max_side, jpeg_quality, packed_frames, resized_frames)
 
-    for frame_idx in frame_indices:
+    if resize_only:
+        pack = FramePack(get_pack_path(video_output_path)) if store == 'pack' else None
+        for frame_idx in resize_only:
+            if pack is not None:
+                data = pack.read(frame_idx)
+            else:
+                with open(os.path.join(video_output_path, f"{frame_idx}.jpg"), 'rb') as f:
+                    data = f.read()
+            resized = resize_frame_bytes(data, max_side, jpeg_quality)
+            if store == 'pack':
+                resized_frames[frame_idx] = resized
+            else:
+                with open(os.path.join(resized_output_path, f"{frame_idx}.jpg"), 'wb') as f:
+                    f.write(resized)
+        if pack is not None:
+            pack.close()
+
+    if frame_indices and not os.path.exists(video_path):
+        print(f"video {video_uid} not found, skip")
+        frame_indices = []
+
+    if frame_indices:
+        # 每个视频只由一个任务处理, 用完即释放, 不做跨任务缓存
+        vr = open_video_reader(video_path)
+
+        num_frames = len(vr)
+        for frame_idx in frame_indices:
+            if frame_idx < 0 or frame_idx >= num_frames:
+                print(f"frame {frame_idx} out of range, skip")
+        frame_indices = [frame_idx for frame_idx in frame_indices if 0 <= frame_idx < num_frames]
+
+        if keyframes is None:
+            keyframes = np.asarray(vr.get_key_indices(), dtype=np.int64)
+
+        # 实际解码的帧 -> 以哪些帧号保存
+        targets = defaultdict(list)
+        for frame_idx, source_idx in zip(frame_indices, snap_to_keyframes(frame_indices, keyframes, snap_frames).tolist()):
+            targets[source_idx].append(frame_idx)
+        mode = plan_decode(sorted(targets), keyframes)
+
+        _decode_and_store(vr, targets, mode, *store_args)
+
+    if packed_frames:
+        write_frame_pack(get_pack_path(video_output_path), packed_frames)
+    if resized_frames:
+        write_frame_pack(get_pack_path(resized_output_path), resized_frames)
+
+    return keyframes
+
+def plan_video_frames(methods, cgbench_data, video_meta_info, video_uids, num_segments, interval_num_segments=None):
+    """
+    Group every requested frame index by video_uid, over all methods and num_segment values
+    (interval_num_segments for the interval method, when given).
+    Returns {video_uid: sorted list of unique frame indices}.
+    """
+    plan = defaultdict(set)
+    if interval_num_segments is None:
+        interval_num_segments = num_segments
+
+    if 'global' in methods:
+        max_frames = [video_meta_info[video_uid]["max_frame"] for video_uid in video_uids]
+        for frame_indices in sample_global_batch(max_frames, num_segments).values():
+            for video_uid, video_frame_indices in zip(video_uids, frame_indices.tolist()):
+                plan[video_uid].update(video_frame_indices)
 
-        frame_filename = os.path.join(video_output_path, f"{frame_idx}.jpg")
-        if os.path.exists(frame_filename):
-            continue
-
-        # 抽帧并保存
-        try:
-            frame = vr[frame_idx].asnumpy() 
-            image = Image.fromarray(frame)  
-            image.save(frame_filename, 'JPEG') 
-        except IndexError:
-            print(f"frame {frame_idx} out of range, skip")
-
-def process_global_frames(cg_videos_path, video_meta_info, output_images_path, num_segment):
-    video_uids = list(set(os.path.splitext(f)[0] for f in os.listdir(cg_videos_path) if f.endswith('.mp4'))) 
-    
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
+    if 'interval' in methods:
+        items = [item for item in cgbench_data if item['video_uid'] in video_meta_info]
+        clue_intervals_list = [item.get('clue_intervals', []) for item in items]
+        fps_list = [video_meta_info[item['video_uid']]['fps'] for item in items]
+        for frame_indices in sample_clue_batch(clue_intervals_list, fps_list, interval_num_segments).values():
+            for item, question_frame_indices in zip(items, frame_indices):
+                plan[item['video_uid']].update(question_frame_indices)
+
+    return {video_uid: sorted(frame_indices) for video_uid, frame_indices in plan.items() if frame_indices}
+
+def process_frame_plan(plan, video_meta_info, cg_videos_path, output_images_path, pool='thread', workers=None, batch_size=8, queue_size=2, store='jpg',
+                       max_side=0, jpeg_quality=75, keyframe_index=None, snap_tolerance=0):
+    """
+    Extract every planned video. keyframe_index ({video_uid: (size, mtime_ns, keyframes)}) is
+    updated in place with the keyframes of videos it did not cover yet; returns how many were added.
+    snap_tolerance (seconds) lets frames take the content of a keyframe that close; those frames
+    go to get_snap_root(output_images_path) instead, so exact-frame runs never reuse them.
+    """
+    if keyframe_index is None:
+        keyframe_index = {}
+    indexed = 0
+
+    if snap_tolerance > 0:
+        output_images_path = get_snap_root(output_images_path, snap_tolerance)
+        os.makedirs(output_images_path, exist_ok=True)
+
+    # 长视频优先, 避免尾部只剩一个 worker 在跑
+    video_uids = sorted(plan, key=lambda video_uid: video_meta_info.get(video_uid, {}).get("max_frame", 0), reverse=True)
+
+    if pool == 'process':
+        executor_cls = concurrent.futures.ProcessPoolExecutor
+    else:
+        executor_cls = concurrent.futures.ThreadPoolExecutor
+
+    with executor_cls(max_workers=workers) as executor:
+        futures = {}
         for video_uid in video_uids:
             video_path = os.path.join(cg_videos_path, f"{video_uid}.mp4")
-            max_frame = video_meta_info[video_uid]["max_frame"] 
-            frame_indices = sample_frames_global_average(max_frame, num_segment)
-
-            futures.append(executor.submit(process_video_frame, video_uid, frame_indices, cg_videos_path, output_images_path))
-
-        for _ in tqdm(concurrent.futures.as_completed(futures), desc="process", total=len(futures), ncols=100):
-            pass
-
-def process_cgbench_data(cgbench_data, video_meta_info, cg_videos_path, output_images_path, num_segment):
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for item in cgbench_data:
-            video_uid = item['video_uid']
-            clue_intervals = item.get('clue_intervals', [])
-
-            if video_uid in video_meta_info:
-                video_info = video_meta_info[video_uid]
-                fps = video_info['fps']
-                max_frame = video_info['max_frame']
-                frame_indices = sample_frames_clue_average(clue_intervals, num_segment, fps)
-
-                futures.append(executor.submit(process_video_frame, video_uid, frame_indices, cg_videos_path, output_images_path))
-
-        for _ in tqdm(concurrent.futures.as_completed(futures), desc="process", total=len(futures), ncols=100):
-            pass
-
-def sample_frames_global_average(max_frame, num_segment):
-    frame_indices = []
-    if num_segment != 0.0:
-        seg_size = float(max_frame) / num_segment
-        frame_indices = np.array([ 
-            int(seg_size / 2 + np.round(seg_size * idx)) 
-            for idx in range(num_segment)
-        ])
-    return frame_indices
-
-def sample_frames_clue_average(clue_intervals, num_segment, fps):
-    clues_frame_intervals = [(round(interval[0] * fps), round(interval[1] * fps)) for interval in clue_intervals]
-    clue_durations = [interval[1] - interval[0] for interval in clues_frame_intervals]
-    total_duration = sum(clue_durations)
-    if num_segment >= total_duration:
-        return [frame for interval in clues_frame_intervals for frame in range(interval[0], interval[1])]
-    frames_per_clue = [int(num_segment * (duration / total_duration)) for duration in clue_durations]
-    frame_indices = []
-    for i, (interval, num_frames) in enumerate(zip(clues_frame_intervals, frames_per_clue)):
-        num_frames = max(1, num_frames)
-        seg_size = (interval[1] - interval[0]) / num_frames
-        clue_frame_indices = [
-            int(interval[0] + seg_size / 2 + seg_size * idx) for idx in range(num_frames)
-        ]
-        frame_indices.extend(clue_frame_indices)
-    return frame_indices
-
-def parse_args():
-    parser = argparse.ArgumentParser(description="")
-    parser.add_argument('--method', choices=['global', 'interval'], required=True, help="")
-    parser.add_argument('--num_segment', type=int, required=True, help="")
-    return parser.parse_args()
+            keyframes = get_cached_keyframes(keyframe_index, video_uid, video_path)
+            snap_frames = int(round(snap_tolerance * video_meta_info.get(video_uid, {}).get("fps", 0)))
+            future = executor.submit(process_video_frames, video_uid, plan[video_uid], cg_videos_path, output_images_path, batch_size, queue_size, store,
+                                     max_side, jpeg_quality, keyframes, snap_frames)
+            futures[future] = (video_uid, video_path, keyframes is None)
 
-def main():
+        for future in tqdm(concurrent.futures.as_completed(futures), desc="process", total=len(futures), ncols=100):
+            video_uid, video_path, missing = futures[future]
+            try:
+                keyframes = future.result()
+            except Exception as e:
+                print(f"Error extracting frames: {e}")
+                continue
+            if missing and keyframes is not None:
+                keyframe_index[video_uid] = get_video_stat(video_path) + (keyframes,)
+                indexed += 1
 
-    args = parse_args()
+    return indexed
 
-    video_meta_info_path = './run/video_meta_info.json'
-    cgbench_json_path = './cgbench_mini.json'
-    cg_videos_path = './cg_videos_720p/'
-    output_images_path = './cg_images/'
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument('--method', choices=['global', 'interval'], nargs='+', required=True,
+                        help="one or more sampling methods, planned together per video")
+    parser.add_argument('--num_segment', type=int, nargs='+', required=True,
+                        help="one or more num_segment values, planned together per video")
+    parser.add_argument('--interval_num_segment', type=int, nargs='+', default=None,
+                        help="num_segment values of the interval method when they differ from --num_segment")
+    parser.add_argument('--pool', choices=['thread', 'process'], default='thread',
+                        help="use a process pool to keep JPEG encoding off a shared GIL")
+    parser.add_argument('--workers', type=int, default=None, help="number of pool workers")
+    parser.add_argument('--batch_size', type=int, default=8, help="frames decoded per get_batch call")
+    parser.add_argument('--queue_size', type=int, default=2, help="decoded batches buffered per video")
+    parser.add_argument('--store', choices=['jpg', 'pack'], default='jpg',
+                        help="loose <video_uid>/<frame_idx>.jpg files, or one packed file per video")
+    parser.add_argument('--max_side', type=int, default=0,
+                        help="also write frames resized to this longer side, for run_api.py --max_side (0: off)")
+    parser.add_argument('--jpeg_quality', type=int, default=75, help="JPEG quality of the resized frames")
+    parser.add_argument('--snap_tolerance', type=float, default=0,
+                        help="seconds: store the nearest keyframe instead of a frame this close to it, under <image_root>_snap<tol> (global only, 0: exact frames)")
+    args = parser.parse_args(argv)
+    if args.snap_tolerance > 0 and 'interval' in args.method:
+        parser.error("--snap_tolerance only applies to --method global")
+    return args
+
+def extract(args, cgbench_json_path='./cgbench_mini.json', cg_videos_path='./cg_videos_720p/', output_images_path='./cg_images/',
+            video_meta_info=None):
+    """Extract the union of the frames planned for args.method x args.num_segment into output_images_path."""
 
     os.makedirs(output_images_path, exist_ok=True)
-    
-    with open(video_meta_info_path, 'r', encoding='utf-8') as f:
-        video_meta_info = json.load(f)
-
-    with open(cgbench_json_path, 'r', encoding='utf-8') as f:
-        cgbench_data = json.load(f)
-
-    if args.method == 'global':
-        process_global_frames(cg_videos_path, video_meta_info, output_images_path, num_segment=args.num_segment)
-    
-    elif args.method == 'interval':
-        process_cgbench_data(cgbench_data, video_meta_info, cg_videos_path, output_images_path, num_segment=args.num_segment)
-    
+
+    if video_meta_info is None:
+        video_meta_info = load_video_meta()
+
+    cgbench_data = []
+    if 'interval' in args.method:
+        # 只取规划抽帧需要的字段, 不整体加载标注文件
+        cgbench_data = list(iter_json_items(cgbench_json_path, ['video_uid', 'clue_intervals']))
+
+    video_uids = []
+    if 'global' in args.method:
+        video_uids = sorted(set(os.path.splitext(f)[0] for f in os.listdir(cg_videos_path) if f.endswith('.mp4')))
+
+    plan = plan_video_frames(args.method, cgbench_data, video_meta_info, video_uids, args.num_segment, args.interval_num_segment)
+    print(f"{len(plan)} videos, {sum(len(v) for v in plan.values())} frames planned")
+
+    if args.snap_tolerance > 0:
+        print(f"snapped frames go to {get_snap_root(output_images_path, args.snap_tolerance)}, pass it to run_api.py as --image_root")
+
+    keyframe_index = load_keyframe_index(KEYFRAME_INDEX_PATH)
+
+    indexed = process_frame_plan(plan, video_meta_info, cg_videos_path, output_images_path,
+                                 pool=args.pool, workers=args.workers, batch_size=args.batch_size, queue_size=args.queue_size, store=args.store,
+                                 max_side=args.max_side, jpeg_quality=args.jpeg_quality, keyframe_index=keyframe_index, snap_tolerance=args.snap_tolerance)
+
+    if indexed:
+        save_keyframe_index(keyframe_index, KEYFRAME_INDEX_PATH)
+
+def main():
+
+    extract(parse_args())
+
     print("complete")
 
 if __name__ == '__main__':
@@ -0,0 +1,72 @@
+import io
+import os
+import threading
+import os.path as osp
+
+from PIL import Image
+
+from frame_store import PackedFrame, get_pack_path, open_frame_pack, read_frame_bytes
+
+
+def get_resized_root(image_root, max_side, quality):
+    """./cg_images -> ./cg_images_s512_q75, the cache of frames resized for the API."""
+    return f"{osp.normpath(image_root)}_s{max_side}_q{quality}"
+
+def resize_image(image, max_side):
+    """Downscale so the longer side is at most max_side, keeping the aspect ratio."""
+    if max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side), Image.BICUBIC)
+    return image
+
+def encode_jpeg(image, quality):
+    byte_stream = io.BytesIO()
+    image.save(byte_stream, 'JPEG', quality=quality)
+    return byte_stream.getvalue()
+
+def resize_frame_bytes(data, max_side, quality):
+    with Image.open(io.BytesIO(data)) as image:
+        return encode_jpeg(resize_image(image.convert('RGB'), max_side), quality)
+
+def get_frame_location(image):
+    """(video_uid, frame_idx) of a loose <video_uid>/<frame_idx>.jpg or a packed frame."""
+    if isinstance(image, PackedFrame):
+        return osp.splitext(osp.basename(image.pack_path))[0], int(image.frame_idx)
+    return osp.basename(osp.dirname(image)), int(osp.splitext(osp.basename(image))[0])
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def get_resized_frame(image, resized_root, max_side, quality):
+    """
+    The resized copy of a frame: from resized_root (pack or loose jpg) if it was made after the
+    original was last written, otherwise resized now and cached there as a loose jpg.
+    """
+    video_uid, frame_idx = get_frame_location(image)
+    resized_dir = osp.join(resized_root, video_uid)
+
+    # 原图 (或其所在的包) 比缩小版新时, 缩小版已过期
+    source_mtime = get_mtime(image.pack_path if isinstance(image, PackedFrame) else image)
+
+    pack_path = get_pack_path(resized_dir)
+    pack = open_frame_pack(pack_path)
+    if pack is not None and frame_idx in pack and get_mtime(pack_path) >= source_mtime:
+        return PackedFrame(pack_path, frame_idx)
+
+    resized_path = osp.join(resized_dir, f"{frame_idx}.jpg")
+    resized_mtime = get_mtime(resized_path)
+    if resized_mtime is None or resized_mtime < source_mtime:
+        data = resize_frame_bytes(read_frame_bytes(image), max_side, quality)
+        os.makedirs(resized_dir, exist_ok=True)
+        tmp_path = f"{resized_path}.tmp{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, resized_path)
+    return resized_path
+
+def resize_frames(image_paths, image_root, max_side, quality):
+    resized_root = get_resized_root(image_root, max_side, quality)
+    return [get_resized_frame(image, resized_root, max_side, quality) for image in image_paths]
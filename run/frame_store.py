@@ -0,0 +1,214 @@
+import os
+import mmap
+import struct
+import argparse
+import threading
+from collections import namedtuple, OrderedDict
+
+from tqdm import tqdm
+
+# 打包格式: header | index (frame_idx, offset, length) * count | jpeg bytes ...
+PACK_MAGIC = b'CGFS'
+PACK_VERSION = 1
+PACK_SUFFIX = '.pack'
+HEADER = struct.Struct('<4sII')
+INDEX_ENTRY = struct.Struct('<qQI')
+
+PackedFrame = namedtuple('PackedFrame', ['pack_path', 'frame_idx'])
+
+# 直接从视频解码的帧 (--frame_source video), 按 max_side / quality 编码
+VideoFrame = namedtuple('VideoFrame', ['video_path', 'frame_idx', 'max_side', 'quality'])
+
+_packs = {}
+_packs_lock = threading.Lock()
+
+
+class ByteLRUCache:
+    """Thread-safe LRU cache bounded by the total size of its values in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.cur_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, size):
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            if key in self._data:
+                self.cur_bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.cur_bytes += size
+            while self.cur_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.cur_bytes -= evicted_size
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self.cur_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.cur_bytes -= evicted_size
+
+def get_pack_path(image_dir):
+    """cg_images/<video_uid> -> cg_images/<video_uid>.pack"""
+    return image_dir.rstrip('/\\') + PACK_SUFFIX
+
+class FramePack:
+    """Read-only, memory-mapped view of one packed video."""
+
+    def __init__(self, pack_path):
+        self.pack_path = pack_path
+        self._lock = threading.Lock()
+        with open(pack_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count = HEADER.unpack_from(self._mm, 0)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise ValueError(f"{pack_path} is not a frame pack")
+
+        self.index = {}
+        pos = HEADER.size
+        for _ in range(count):
+            frame_idx, offset, length = INDEX_ENTRY.unpack_from(self._mm, pos)
+            self.index[frame_idx] = (offset, length)
+            pos += INDEX_ENTRY.size
+
+    def __contains__(self, frame_idx):
+        return int(frame_idx) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame_indices(self):
+        return sorted(self.index)
+
+    def read(self, frame_idx):
+        """JPEG bytes of frame_idx, or None if the pack has been closed (replaced by a newer file)."""
+        offset, length = self.index[int(frame_idx)]
+        # 与 close 互斥: 被替换的旧包要等正在进行的读取完成后才关闭
+        with self._lock:
+            if self._mm.closed:
+                return None
+            return self._mm[offset:offset + length]
+
+    def close(self):
+        with self._lock:
+            self._mm.close()
+
+def open_frame_pack(pack_path):
+    """Return a cached FramePack for pack_path, or None if it does not exist. Reopened when the file changes."""
+    try:
+        mtime = os.stat(pack_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    with _packs_lock:
+        cached = _packs.get(pack_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        pack = FramePack(pack_path)
+        _packs[pack_path] = (mtime, pack)
+    if cached is not None:
+        cached[1].close()
+    return pack
+
+def write_frame_pack(pack_path, frames):
+    """
+    Write {frame_idx: jpeg_bytes} into pack_path, keeping frames already in the pack.
+    The file is written to a temp path and renamed, so readers never see a partial pack.
+    """
+    merged = {}
+    if os.path.exists(pack_path):
+        existing = FramePack(pack_path)
+        for frame_idx in existing.frame_indices():
+            merged[frame_idx] = existing.read(frame_idx)
+        existing.close()
+    merged.update({int(frame_idx): data for frame_idx, data in frames.items()})
+
+    frame_indices = sorted(merged)
+    offset = HEADER.size + INDEX_ENTRY.size * len(frame_indices)
+
+    tmp_path = f"{pack_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(PACK_MAGIC, PACK_VERSION, len(frame_indices)))
+        for frame_idx in frame_indices:
+            f.write(INDEX_ENTRY.pack(frame_idx, offset, len(merged[frame_idx])))
+            offset += len(merged[frame_idx])
+        for frame_idx in frame_indices:
+            f.write(merged[frame_idx])
+    os.replace(tmp_path, pack_path)
+
+def read_frame_bytes(image):
+    """Encoded JPEG bytes for a loose image path, a PackedFrame or a VideoFrame."""
+    if isinstance(image, PackedFrame):
+        while True:
+            data = open_frame_pack(image.pack_path).read(image.frame_idx)
+            if data is not None:
+                return data
+            # 取到的包刚被新文件替换并关闭, 重新打开
+    if isinstance(image, VideoFrame):
+        from video_frames import read_video_frame
+        return read_video_frame(image)
+    with open(image, 'rb') as f:
+        return f.read()
+
+def get_frame_size(image):
+    """Size in bytes of the encoded frame, without reading it (video frames are decoded and cached)."""
+    if isinstance(image, PackedFrame):
+        return open_frame_pack(image.pack_path).index[int(image.frame_idx)][1]
+    if isinstance(image, VideoFrame):
+        return len(read_frame_bytes(image))
+    return os.path.getsize(image)
+
+def pack_image_dir(image_dir, remove_loose=False):
+    """Pack an existing cg_images/<video_uid>/ directory of <frame_idx>.jpg files."""
+    frames = {}
+    for file in os.listdir(image_dir):
+        name, ext = os.path.splitext(file)
+        if ext == '.jpg' and name.isdigit():
+            with open(os.path.join(image_dir, file), 'rb') as f:
+                frames[int(name)] = f.read()
+    if not frames:
+        return 0
+
+    write_frame_pack(get_pack_path(image_dir), frames)
+
+    if remove_loose:
+        for frame_idx in frames:
+            os.remove(os.path.join(image_dir, f"{frame_idx}.jpg"))
+        if not os.listdir(image_dir):
+            os.rmdir(image_dir)
+    return len(frames)
+
+def main():
+    parser = argparse.ArgumentParser(description="pack loose extracted frames into one file per video")
+    parser.add_argument('--image_root', type=str, default="./cg_images")
+    parser.add_argument('--remove_loose', action='store_true', help="delete the loose jpgs after packing")
+    args = parser.parse_args()
+
+    image_dirs = [
+        os.path.join(args.image_root, d) for d in os.listdir(args.image_root)
+        if os.path.isdir(os.path.join(args.image_root, d))
+    ]
+
+    total = 0
+    for image_dir in tqdm(image_dirs, desc="packing", ncols=100):
+        total += pack_image_dir(image_dir, args.remove_loose)
+
+    print(f"packed {total} frames from {len(image_dirs)} videos")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+_decoder = json.JSONDecoder()
+
+
+def _iter_array_raw(f, chunk_size):
+    """Items of a top-level json array, decoded one at a time with raw_decode."""
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+
+    while True:
+        # 跳过空白, 开头的 [ 和元素之间的 ,
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf):
+                break
+            if eof:
+                raise ValueError("unexpected end of json array")
+            buf, pos = f.read(chunk_size), 0
+            eof = not buf
+
+        if not started:
+            if buf[pos] != '[':
+                raise ValueError("expected a top-level json array")
+            started = True
+            pos += 1
+            continue
+        if buf[pos] == ']':
+            return
+        if buf[pos] == ',':
+            pos += 1
+            continue
+
+        while True:
+            try:
+                item, end = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            # 数字可能恰好在块边界被截断, 后面还有内容时才能确定已读完
+            if end == len(buf) and not eof:
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            break
+        yield item
+        pos = end
+
+def _project(items, fields):
+    for item in items:
+        if fields is not None:
+            item = {key: item[key] for key in fields if key in item}
+        yield item
+
+def iter_json_items(path, fields=None, chunk_size=1 << 20):
+    """
+    Stream the items of a json array file (e.g. cgbench_mini.json) without loading it whole.
+    With fields, each item is projected to those keys (missing keys are left out).
+    Uses ijson when it is installed, otherwise incremental raw_decode.
+    """
+    if ijson is not None:
+        with open(path, 'rb') as f:
+            yield from _project(ijson.items(f, 'item', use_float=True), fields)
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from _project(_iter_array_raw(f, chunk_size), fields)
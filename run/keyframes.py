@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+
+# 关键帧索引缓存, 与 video_meta_info.json 放在一起
+KEYFRAME_INDEX_PATH = './run/video_keyframes.npz'
+
+# 一次 seek (demux + 清空解码器) 约等于解码几帧的开销
+SEEK_COST = 4
+
+
+def get_snap_root(image_root, tolerance):
+    """./cg_images -> ./cg_images_snap0.5: snapped frames never share a root with exact frames."""
+    return f"{os.path.normpath(image_root)}_snap{tolerance:g}"
+
+def get_video_stat(video_path):
+    stat = os.stat(video_path)
+    return stat.st_size, stat.st_mtime_ns
+
+def load_keyframe_index(index_path=KEYFRAME_INDEX_PATH):
+    """{video_uid: (size, mtime_ns, keyframe indices)}, empty if there is no index yet."""
+    if not os.path.exists(index_path):
+        return {}
+    with np.load(index_path) as data:
+        uids = data['uids'].tolist()
+        offsets = data['offsets']
+        keyframes = data['keyframes']
+        sizes = data['sizes'].tolist()
+        mtimes = data['mtimes'].tolist()
+    return {
+        uid: (sizes[i], mtimes[i], keyframes[offsets[i]:offsets[i + 1]])
+        for i, uid in enumerate(uids)
+    }
+
+def save_keyframe_index(index, index_path=KEYFRAME_INDEX_PATH):
+    uids = sorted(index)
+    offsets = np.zeros(len(uids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(index[uid][2]) for uid in uids])
+    keyframes = np.concatenate([np.asarray(index[uid][2], dtype=np.int64) for uid in uids]) if uids else np.zeros(0, dtype=np.int64)
+
+    tmp_path = f"{index_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, uids=np.array(uids), offsets=offsets, keyframes=keyframes,
+                 sizes=np.array([index[uid][0] for uid in uids], dtype=np.int64),
+                 mtimes=np.array([index[uid][1] for uid in uids], dtype=np.int64))
+    os.replace(tmp_path, index_path)
+
+def get_cached_keyframes(index, video_uid, video_path):
+    """Keyframes of the video if the index entry still matches its size/mtime, else None."""
+    entry = index.get(video_uid)
+    if entry is None or not os.path.exists(video_path):
+        return None
+    if (entry[0], entry[1]) != get_video_stat(video_path):
+        return None
+    return entry[2]
+
+def snap_to_keyframes(frame_indices, keyframes, tolerance):
+    """For each frame, the nearest keyframe if it is at most tolerance frames away, else the frame itself."""
+    frame_indices = np.asarray(frame_indices, dtype=np.int64)
+    keyframes = np.asarray(keyframes, dtype=np.int64)
+    if tolerance <= 0 or len(keyframes) == 0:
+        return frame_indices
+
+    right = np.clip(np.searchsorted(keyframes, frame_indices), 0, len(keyframes) - 1)
+    left = np.clip(right - 1, 0, len(keyframes) - 1)
+    nearest = np.where(np.abs(keyframes[left] - frame_indices) <= np.abs(keyframes[right] - frame_indices),
+                       keyframes[left], keyframes[right])
+    return np.where(np.abs(nearest - frame_indices) <= tolerance, nearest, frame_indices)
+
+def plan_decode(frame_indices, keyframes, seek_cost=SEEK_COST):
+    """
+    'sequential' (one seek, decode every frame up to the last one) or 'seek' (jump to the keyframe
+    before each frame that is in a later GOP), whichever decodes fewer frames. frame_indices must be sorted.
+    """
+    frame_indices = np.asarray(frame_indices, dtype=np.int64)
+    keyframes = np.asarray(keyframes, dtype=np.int64)
+    if len(frame_indices) == 0 or len(keyframes) == 0:
+        return 'seek'
+
+    prev_key = keyframes[np.clip(np.searchsorted(keyframes, frame_indices, side='right') - 1, 0, None)]
+    sequential = frame_indices[-1] - prev_key[0] + 1
+
+    prev_frame = np.concatenate([[-1], frame_indices[:-1]])
+    # 上一帧已在同一 GOP 内时继续往后解, 否则 seek 到关键帧
+    same_gop = prev_frame >= prev_key
+    seek = np.where(same_gop, frame_indices - prev_frame, frame_indices - prev_key + 1 + seek_cost).sum()
+
+    return 'sequential' if sequential <= seek else 'seek'
@@ -0,0 +1,94 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def make_cache_key(model, sys_prompt, prompt, frame_hashes, temperature):
+    """Content address of a request: model, prompts, ordered frame content hashes and temperature."""
+    payload = json.dumps([model, sys_prompt, prompt, list(frame_hashes), temperature], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class RequestCache:
+    """
+    On-disk response cache, one json per request under cache_dir/<key[:2]>/<key>.json.
+    Least recently used entries are evicted once the cache grows past max_bytes.
+    A read-only cache never writes (replay mode).
+    """
+
+    def __init__(self, cache_dir, max_bytes, read_only=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # key -> size, 按最近使用时间排序
+        entries = []
+        for sub_dir in os.scandir(cache_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, entry.name[:-len('.json')], stat.st_size))
+        entries.sort()
+        self._entries = OrderedDict((key, size) for _, key, size in entries)
+        self.cur_bytes = sum(self._entries.values())
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        if not self.read_only:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return record
+
+    def put(self, key, record):
+        if self.read_only:
+            return
+
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(record, ensure_ascii=False).encode('utf-8')
+        tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self.cur_bytes -= self._entries.pop(key)
+            self._entries[key] = len(data)
+            self.cur_bytes += len(data)
+            while self.cur_bytes > self.max_bytes and len(self._entries) > 1:
+                evicted_key, evicted_size = self._entries.popitem(last=False)
+                self.cur_bytes -= evicted_size
+                evicted.append(evicted_key)
+
+        for evicted_key in evicted:
+            try:
+                os.remove(self.get_path(evicted_key))
+            except FileNotFoundError:
+                pass
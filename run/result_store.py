@@ -0,0 +1,300 @@
+import os
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    qid TEXT NOT NULL,
+    result_key TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS results_key ON results (qid, result_key, version);
+CREATE INDEX IF NOT EXISTS results_result_key ON results (result_key, qid);
+CREATE TABLE IF NOT EXISTS responses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    qid TEXT NOT NULL,
+    result_key TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    response TEXT NOT NULL,
+    latency REAL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_key ON responses (result_key, qid);
+CREATE TABLE IF NOT EXISTS annotations (
+    qid TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    video_uid TEXT,
+    version INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+"""
+
+# 各 qid 某个 result_key 的最新版本
+KEY_VERSIONS = "SELECT qid, MAX(version) AS version FROM results WHERE result_key = ? GROUP BY qid"
+
+PENDING_RESULT = f"""
+SELECT a.path FROM annotations a
+LEFT JOIN ({KEY_VERSIONS}) r ON r.qid = a.qid
+WHERE r.qid IS NULL OR r.version != a.version
+ORDER BY a.path
+"""
+
+# eval_open_step_1: 有 open 结果, 且 step_1 缺失或版本落后
+PENDING_STEP_1 = f"""
+SELECT a.path FROM annotations a
+JOIN ({KEY_VERSIONS}) o ON o.qid = a.qid
+LEFT JOIN ({KEY_VERSIONS}) s1 ON s1.qid = a.qid
+WHERE s1.qid IS NULL OR s1.version != o.version
+ORDER BY a.path
+"""
+
+# eval_open_step_2: 有 step_1 结果, 且 step_2 缺失或版本落后
+PENDING_STEP_2 = f"""
+SELECT a.path FROM annotations a
+JOIN ({KEY_VERSIONS}) o ON o.qid = a.qid
+JOIN ({KEY_VERSIONS}) s1 ON s1.qid = a.qid
+LEFT JOIN ({KEY_VERSIONS}) s2 ON s2.qid = a.qid
+WHERE s2.qid IS NULL OR s2.version != s1.version
+ORDER BY a.path
+"""
+
+# 每个 (qid, result_key) 取版本最高、最新写入的一条
+LATEST_RESULTS = """
+SELECT qid, result_key, version, result FROM (
+    SELECT qid, result_key, version, result,
+           ROW_NUMBER() OVER (PARTITION BY qid, result_key ORDER BY version DESC, id DESC) AS rn
+    FROM results {where}
+) WHERE rn = 1
+"""
+
+# 每个 qid 某个 result_key 最新的原始回复, 连同其标注文件路径
+LATEST_RESPONSES = """
+SELECT a.path, r.version, r.response FROM (
+    SELECT qid, version, response,
+           ROW_NUMBER() OVER (PARTITION BY qid ORDER BY version DESC, id DESC) AS rn
+    FROM responses WHERE result_key = ?
+) r JOIN annotations a ON a.qid = r.qid
+WHERE r.rn = 1
+ORDER BY a.path
+"""
+
+INSERT_RESULTS = "INSERT OR REPLACE INTO results (qid, result_key, version, result, created_at) VALUES (?, ?, ?, ?, ?)"
+INSERT_RESPONSES = ("INSERT INTO responses (qid, result_key, version, response, latency, prompt_tokens, completion_tokens, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+
+STEP_SEP = '/'
+
+_store = None
+
+
+def get_step_key(open_key, step):
+    """open_..._True_True_True + step_1 -> open_..._True_True_True/step_1"""
+    return f"{open_key}{STEP_SEP}{step}"
+
+class ResultStore:
+    """
+    Append-only SQLite (WAL) store of model results keyed on (qid, result_key, version).
+    Writes are queued and committed in batches by a single writer thread.
+    With read_only=True the database is opened read-only (for stats) and nothing is ever written.
+    """
+
+    def __init__(self, db_path, batch_size=256, batch_wait=0.2, read_only=False):
+        self.db_path = db_path
+        self.read_only = read_only
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+        if read_only:
+            return
+        conn = self.connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.read_only:
+                conn = sqlite3.connect(f"file:{os.path.abspath(self.db_path)}?mode=ro", uri=True, timeout=60)
+            else:
+                conn = sqlite3.connect(self.db_path, timeout=60)
+                conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _enqueue(self, statement, row):
+        if self.read_only:
+            raise ValueError(f"{self.db_path} is opened read-only")
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, daemon=True)
+                self._writer.start()
+        self._queue.put((statement, row))
+
+    def put(self, qid, result_key, version, result):
+        self._enqueue(INSERT_RESULTS, (str(qid), result_key, version, json.dumps(result), time.time()))
+
+    def put_response(self, qid, result_key, version, response, latency=None, usage=None):
+        """Keep the raw model response so results can be re-scored offline."""
+        usage = usage or {}
+        self._enqueue(INSERT_RESPONSES, (str(qid), result_key, version, response, latency,
+                                         usage.get("prompt_tokens"), usage.get("completion_tokens"), time.time()))
+
+    def _write_loop(self):
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            rows = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(rows) < self.batch_size and rows[-1] is not None:
+                try:
+                    rows.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            stop = rows[-1] is None
+            batch = [row for row in rows if row is not None]
+            if batch:
+                try:
+                    with conn:
+                        for statement, row in batch:
+                            conn.execute(statement, row)
+                except sqlite3.Error as e:
+                    print(f"Error writing {len(batch)} results: {e}")
+            for _ in rows:
+                self._queue.task_done()
+            if stop:
+                conn.close()
+                return
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        with self._writer_lock:
+            if self._writer is not None:
+                self._queue.put(None)
+                self._writer.join()
+                self._writer = None
+
+    def iter_latest(self, qid=None):
+        """Yield (qid, result_key, version, result) for the latest row of every result."""
+        if qid is None:
+            cursor = self.connect().execute(LATEST_RESULTS.format(where=""))
+        else:
+            cursor = self.connect().execute(LATEST_RESULTS.format(where="WHERE qid = ?"), (str(qid),))
+        for row_qid, result_key, version, result in cursor:
+            yield row_qid, result_key, version, json.loads(result)
+
+    def get_results(self, qid):
+        """Results of one question, in the same nested layout as anno["results"]."""
+        results = {}
+        for _, result_key, version, result in self.iter_latest(qid):
+            add_result(results, result_key, version, result)
+        return results
+
+    def refresh_annotations(self, anno_root):
+        """
+        Bring the annotation index up to date with anno_root. Only files whose size/mtime changed
+        are parsed; results still embedded in them (written without a store) are imported.
+        """
+        conn = self.connect()
+        indexed = {
+            path: (qid, mtime_ns, size)
+            for qid, path, mtime_ns, size in conn.execute("SELECT qid, path, mtime_ns, size FROM annotations")
+        }
+
+        seen = set()
+        changed = []
+        for root, _, files in os.walk(anno_root):
+            for file in files:
+                if not file.endswith('.json'):
+                    continue
+                json_path = os.path.join(root, file)
+                seen.add(json_path)
+                stat = os.stat(json_path)
+                if json_path in indexed and indexed[json_path][1:] == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                changed.append((json_path, stat))
+
+        removed = [indexed[path][0] for path in indexed if path not in seen]
+
+        annotation_rows = []
+        result_rows = []
+        now = time.time()
+        for json_path, stat in changed:
+            try:
+                with open(json_path, 'r', encoding='utf-8') as f:
+                    anno = json.load(f)
+            except Exception as e:
+                print(f"Error processing {json_path}: {str(e)}")
+                continue
+            qid = str(anno["qid"])
+            annotation_rows.append((qid, json_path, anno.get("video_uid"), anno["version"], stat.st_mtime_ns, stat.st_size))
+            for result_key, entry in anno.get("results", {}).items():
+                if "version" in entry and "result" in entry:
+                    result_rows.append((qid, result_key, entry["version"], json.dumps(entry["result"]), now))
+                for step in ("step_1", "step_2"):
+                    if step in entry:
+                        result_rows.append((qid, get_step_key(result_key, step), entry[step]["version"], json.dumps(entry[step]["result"]), now))
+
+        with conn:
+            conn.executemany("DELETE FROM annotations WHERE qid = ?", [(qid,) for qid in removed])
+            conn.executemany("INSERT OR REPLACE INTO annotations (qid, path, video_uid, version, mtime_ns, size) VALUES (?, ?, ?, ?, ?, ?)", annotation_rows)
+            conn.executemany("INSERT OR IGNORE INTO results (qid, result_key, version, result, created_at) VALUES (?, ?, ?, ?, ?)", result_rows)
+
+        return len(changed), len(removed)
+
+    def get_pending(self, task_mode, result_key=None, open_key=None):
+        """Annotation paths that still need result_key (or the eval_open step of open_key)."""
+        if task_mode == 'eval_open_step_1':
+            query, params = PENDING_STEP_1, (open_key, get_step_key(open_key, "step_1"))
+        elif task_mode == 'eval_open_step_2':
+            query, params = PENDING_STEP_2, (open_key, get_step_key(open_key, "step_1"), get_step_key(open_key, "step_2"))
+        else:
+            query, params = PENDING_RESULT, (result_key,)
+        return [path for path, in self.connect().execute(query, params)]
+
+    def get_responses(self, result_key):
+        """(annotation path, version, raw response) of the latest stored response per question."""
+        return list(self.connect().execute(LATEST_RESPONSES, (result_key,)))
+
+def add_result(results, result_key, version, result):
+    entry = {"version": version, "result": result}
+    if STEP_SEP in result_key:
+        open_key, step = result_key.split(STEP_SEP, 1)
+        results.setdefault(open_key, {})[step] = entry
+    else:
+        results.setdefault(result_key, {}).update(entry)
+
+def merge_results(anno, results):
+    """Overlay results read from the store onto anno["results"] loaded from the annotation json."""
+    for result_key, entry in results.items():
+        anno["results"].setdefault(result_key, {}).update(entry)
+    return anno
+
+def open_store(db_path):
+    global _store
+    if _store is not None:
+        _store.close()
+    _store = ResultStore(db_path) if db_path else None
+    if _store is not None:
+        atexit.register(_store.close)
+    return _store
+
+def get_store():
+    return _store
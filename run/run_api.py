@@ -7,12 +7,18 @@ import hashlib
 import requests
 import threading
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import traceback
 import logging
 
 from utils import *
+from api_client import APIClient, ByteBudget, estimate_tokens, get_response_content
+from result_store import open_store
+from request_cache import RequestCache, make_cache_key
+from frame_resize import resize_frames
+from video_frames import video_frame_cache
+from video_meta import load_video_meta
 
 API_BASE = '' # Your api_base here
 API_KEY = '' # Your api_key here
@@ -22,7 +28,16 @@ headers = {
     'Content-Type': 'application/json',
 }
 
-def inference(args, sys_prompt, prompt, image_paths):
+client = APIClient()
+
+# 请求体和缓存键共用, 改动时缓存自动失效
+TEMPERATURE = 0.0
+
+request_cache = None
+
+payload_budget = None
+
+def build_request(args, sys_prompt, prompt, image_paths):
 
     content = []
     messages = []
@@ -39,13 +54,25 @@ def inference(args, sys_prompt, prompt, image_paths):
         'model': f'{args.model_name}-{args.model_size}',
         'messages': messages,
         'stream': False,
-        'temperature': 0.0
+        'temperature': TEMPERATURE
     }
 
-    try:
-        response = requests.post(API_BASE, headers=headers, json=json_data, timeout=300)
+    tokens = estimate_tokens(sys_prompt + prompt, len(image_paths))
 
-        time.sleep(1)
+    return json_data, tokens
+
+def encode_body(json_data):
+    return json.dumps(json_data).encode('utf-8')
+
+def send_request(body, tokens):
+    """Returns the response content and {"latency", "usage"} of the call"""
+
+    info = {}
+
+    try:
+        start_time = time.time()
+        response = client.post(API_BASE, headers, body, timeout=300, tokens=tokens)
+        info["latency"] = time.time() - start_time
 
         try:
             response.raise_for_status()
@@ -56,34 +83,108 @@ def inference(args, sys_prompt, prompt, image_paths):
 
         except requests.exceptions.RequestException as e:
             print(f"Request failed: {e}")
-            return None
+            return None, info
 
-        if 'choices' not in result or result['choices'] is None:
-            print("response fail")
-            return None
+        info["usage"] = result.get("usage")
 
-        return result['choices'][0]['message']['content']
+        return get_response_content(result), info
 
-    except (requests.exceptions.ReadTimeout, requests.exceptions.SSLError, requests.exceptions.Timeout) as e:
+    except (requests.exceptions.ReadTimeout, requests.exceptions.SSLError, requests.exceptions.Timeout,
+            requests.exceptions.ConnectionError) as e:
         print(f"Request failed: {e}")
-        return None
+        return None, info
 
-def process_single_file(args, json_file):
-    """Process a single JSON file with error handling"""
+def inference(args, sys_prompt, prompt, image_paths):
+
+    json_data, tokens = build_request(args, sys_prompt, prompt, image_paths)
+
+    response, _ = send_request(encode_body(json_data), tokens)
+
+    return response
+
+def prepare_request(args, json_file):
+    """
+    Load the annotation, its frames and prompt, and build the request.
+    A request answered from the request cache (or skipped in replay mode) has send=False.
+    """
+
+    anno = load_anno(json_file)
+    image_paths, frame_indices = load_video_pipeline_args(args, anno)
+    if args.max_side > 0 and args.frame_source == "images":
+        image_paths = resize_frames(image_paths, args.image_root, args.max_side, args.jpeg_quality)
+
+    prompt = get_prompt(args, anno, frame_indices)
+
+    sys_prompt = SYS[args.task_mode]
+
+    request = {"body": None, "tokens": 0, "cache_key": None, "response": None, "info": {}, "send": True, "budget": 0}
+
+    if request_cache is not None:
+        frame_hashes = [image_content_hash(image) for image in image_paths]
+        request["cache_key"] = make_cache_key(f'{args.model_name}-{args.model_size}', sys_prompt, prompt, frame_hashes, TEMPERATURE)
+        cached = request_cache.get(request["cache_key"])
+        if cached is not None:
+            request.update(response=cached["response"], info={"usage": cached.get("usage"), "cached": True}, send=False)
+            return anno, request
+        if request_cache.read_only:
+            request["send"] = False
+            return anno, request
+
+    # 先占用内存预算, 再构造 base64 请求体. 编码时 base64 字符串, json 字符串和 utf-8 字节
+    # 同时存在, 按三份预留; 编码完只留字节, 预算缩到它的实际大小
+    if payload_budget is not None:
+        request["budget"] = 3 * estimate_payload_bytes(image_paths, sys_prompt + prompt)
+        payload_budget.acquire(request["budget"])
     try:
+        json_data, request["tokens"] = build_request(args, sys_prompt, prompt, image_paths)
+        request["body"] = encode_body(json_data)
+        del json_data
+        if request["budget"] > len(request["body"]):
+            payload_budget.release(request["budget"] - len(request["body"]))
+            request["budget"] = len(request["body"])
+    except Exception:
+        release_request(request)
+        raise
+
+    return anno, request
+
+def release_request(request):
+    """Drop the request body and give its bytes back to the payload budget"""
+
+    request["body"] = None
+    if request["budget"]:
+        payload_budget.release(request["budget"])
+        request["budget"] = 0
 
-        anno = load_json(json_file)
-        image_paths, frame_indices = load_video_pipeline_args(args, anno)
+def finish_request(args, anno, request, json_file):
 
-        prompt = get_prompt(args, anno, frame_indices)
+    response = request["response"]
 
-        sys_prompt = SYS[args.task_mode]
+    # 缓存命中的回复也按当前版本记一行, 标注升版后 --rescore 仍能用到
+    save_response(args, anno, response, request["info"])
 
-        response = inference(args, sys_prompt, prompt, image_paths)
-        result = post_process(args, anno, response)
+    result = post_process(args, anno, response)
 
-        if result is not None:
-            save_result(args, anno, result, json_file)
+    if result is not None:
+        save_result(args, anno, result, json_file)
+
+        # 只缓存能解析出结果的回复, 否则重跑时会一直拿到同一个坏回复
+        if request["send"] and request_cache is not None:
+            request_cache.put(request["cache_key"], {"response": response, "usage": request["info"].get("usage")})
+
+def process_single_file(args, json_file):
+    """Process a single JSON file with error handling"""
+    try:
+
+        anno, request = prepare_request(args, json_file)
+
+        try:
+            if request["send"]:
+                request["response"], request["info"] = send_request(request["body"], request["tokens"])
+        finally:
+            release_request(request)
+
+        finish_request(args, anno, request, json_file)
 
         return json_file, True
     except Exception as e:
@@ -91,7 +192,99 @@ def process_single_file(args, json_file):
         logging.error(traceback.format_exc())
         return json_file, False
 
-def main(args):
+def rescore_single(task_args, anno, response):
+    """Replay post_process on a stored response (runs in a worker process)"""
+
+    return post_process(task_args, anno, response)
+
+def rescore(args, store):
+    """Re-run post_process over the stored raw responses of this result key, without calling the API"""
+
+    store.refresh_annotations(args.anno_root)
+
+    response_key = get_response_key(args)
+    rows = store.get_responses(response_key)
+    print(f"Found {len(rows)} stored responses for {response_key}")
+
+    with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
+        annos = list(executor.map(load_anno, [json_file for json_file, _, _ in rows]))
+
+    # 只保留与当前标注版本一致的回复
+    items = [
+        (json_file, anno, response)
+        for (json_file, version, response), anno in zip(rows, annos)
+        if get_response_version(args, anno) == version
+    ]
+
+    # post_process 只用到 task_mode, 不把 vdict 发给子进程
+    task_args = argparse.Namespace(task_mode=args.task_mode)
+
+    rescored = 0
+    with ProcessPoolExecutor() as executor:
+        if args.task_mode == "miou":
+            # 解析很快, IoU 对所有问题一次批量算完, 不用子进程
+            predictions = [parse_miou_result(response) for _, _, response in items]
+            scored = [i for i, prediction in enumerate(predictions) if prediction is not None]
+            ious = batch_intervals_iou([predictions[i] for i in scored], [items[i][1]["clue_intervals"] for i in scored])
+            results = [None] * len(items)
+            for i, iou in zip(scored, ious.tolist()):
+                results[i] = iou
+        else:
+            results = executor.map(rescore_single, [task_args] * len(items), [anno for _, anno, _ in items],
+                                   [response for _, _, response in items], chunksize=256)
+        for (json_file, anno, _), result in tqdm(zip(items, results), total=len(items), desc="Rescoring"):
+            if result is not None:
+                save_result(args, anno, result, json_file)
+                rescored += 1
+
+    print(f"Rescored {rescored} of {len(rows)} responses")
+
+def run_threads(args, tasks):
+    """
+    Feed pending (task_args, json_file) tasks to the thread pool lazily: at most 2 * num_threads
+    tasks are queued at a time, and each builds its payload just before it is sent.
+    """
+
+    successful = 0
+    failed = 0
+
+    pending = iter(tasks)
+    future_to_file = {}
+
+    with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
+        with tqdm(total=len(tasks), desc="Processing files") as pbar:
+            while True:
+                while len(future_to_file) < 2 * args.num_threads:
+                    task = next(pending, None)
+                    if task is None:
+                        break
+                    task_args, json_file = task
+                    future_to_file[executor.submit(process_single_file, task_args, json_file)] = json_file
+
+                if not future_to_file:
+                    break
+
+                done, _ = wait(future_to_file, return_when=FIRST_COMPLETED)
+                for future in done:
+                    json_file = future_to_file.pop(future)
+                    try:
+                        _, success = future.result()
+                        if success:
+                            successful += 1
+                        else:
+                            failed += 1
+                    except Exception as e:
+                        logging.error(f"Unexpected error processing {json_file}: {str(e)}")
+                        logging.error(traceback.format_exc())
+                        failed += 1
+                    pbar.update(1)
+
+    return successful, failed
+
+def setup(args):
+    """Logging, the shared caches, payload budget and rate limits; returns the result store (or None)"""
+
+    global request_cache, payload_budget
 
     logging.basicConfig(
         level=logging.INFO,
@@ -99,6 +292,45 @@ def main(args):
         filename='processing.log'
     )
 
+    base64_cache.resize(args.image_cache_mb * 1024 * 1024)
+    video_frame_cache.resize(args.video_frame_cache_mb * 1024 * 1024)
+    if args.max_payload_mb > 0:
+        payload_budget = ByteBudget(args.max_payload_mb * 1024 * 1024)
+    client.configure(args.rpm, args.tpm, args.max_retries)
+    store = open_store(args.result_store)
+
+    if args.request_cache:
+        request_cache = RequestCache(args.request_cache, args.request_cache_mb * 1024 * 1024, read_only=args.cache_replay)
+
+    return store
+
+def dispatch(args, tasks):
+    """Run (task_args, json_file) tasks on the thread pool or the async engine; returns (successful, failed)"""
+
+    if args.async_mode:
+        from async_engine import run_async
+        return run_async(args, tasks, prepare_request, finish_request, release_request, API_BASE, headers, client)
+
+    return run_threads(args, tasks)
+
+def log_stats(successful, failed):
+
+    logging.info(f"Processing completed. Successful: {successful}, Failed: {failed}")
+    logging.info(f"Frame cache hits: {base64_cache.hits}, misses: {base64_cache.misses}")
+    if request_cache is not None:
+        logging.info(f"Request cache hits: {request_cache.hits}, misses: {request_cache.misses}")
+
+def main(args):
+
+    store = setup(args)
+
+    if args.rescore:
+        if store is None:
+            raise ValueError("--rescore needs a result store")
+        rescore(args, store)
+        store.close()
+        return
+
     json_files = get_json_files(args)
 
     print(len(json_files))
@@ -107,35 +339,14 @@ def main(args):
     logging.info(f"Found {total_files} files to process")
     print(f"Found {total_files} files to process")
 
+    successful, failed = dispatch(args, [(args, json_file) for json_file in json_files])
 
-    with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
-
-        future_to_file = {
-            executor.submit(process_single_file, args, json_file): json_file
-            for json_file in json_files
-        }
-
-        successful = 0
-        failed = 0
-
-        with tqdm(total=total_files, desc="Processing files") as pbar:
-            for future in as_completed(future_to_file):
-                json_file = future_to_file[future]
-                try:
-                    _, success = future.result()
-                    if success:
-                        successful += 1
-                    else:
-                        failed += 1
-                except Exception as e:
-                    logging.error(f"Unexpected error processing {json_file}: {str(e)}")
-                    logging.error(traceback.format_exc())
-                    failed += 1
-                pbar.update(1)
+    if store is not None:
+        store.close()
 
-    logging.info(f"Processing completed. Successful: {successful}, Failed: {failed}")
+    log_stats(successful, failed)
 
-def get_args():
+def get_parser():
 
     parser = argparse.ArgumentParser(description='run api')
 
@@ -143,8 +354,50 @@ def get_args():
                     help='Number of segments')
 
 
+    parser.add_argument('--rescore', type=str2bool, default=False,
+                    help='Re-score the stored raw responses offline instead of querying the API')
+
+    parser.add_argument('--async_mode', type=str2bool, default=False,
+                    help='Run requests on one asyncio event loop instead of a thread per request')
+    parser.add_argument('--max_in_flight', type=int, default=256,
+                    help='Concurrent requests in async mode')
+
+    parser.add_argument('--max_payload_mb', type=int, default=1024,
+                    help='Budget for request bodies held in memory at once (MB, 0: unlimited)')
+
+    parser.add_argument('--rpm', type=int, default=0,
+                    help='Requests per minute shared by all threads (0: unlimited)')
+    parser.add_argument('--tpm', type=int, default=0,
+                    help='Estimated tokens per minute shared by all threads (0: unlimited)')
+    parser.add_argument('--max_retries', type=int, default=5,
+                    help='Retries on timeouts, 429 and 5xx responses')
+
+    parser.add_argument('--request_cache', type=str, default="./cg_request_cache",
+                    help='On-disk response cache keyed on the request content ("none": disabled)')
+    parser.add_argument('--request_cache_mb', type=int, default=2048,
+                    help='Size limit of the response cache (MB)')
+    parser.add_argument('--cache_replay', type=str2bool, default=False,
+                    help='Only answer from the response cache, never call the API')
+
+    parser.add_argument('--image_cache_mb', type=int, default=1024,
+                    help='Size limit of the shared base64 frame cache (MB)')
+
+    parser.add_argument('--frame_source', type=str, default="images", choices=["images", "video"],
+                    help='Read extracted frames from image_root, or decode them from video_root on the fly')
+    parser.add_argument('--video_root', type=str, default="./cg_videos_720p",
+                    help='Videos decoded with --frame_source video')
+    parser.add_argument('--video_frame_cache_mb', type=int, default=512,
+                    help='Size limit of the shared cache of frames decoded from videos (MB)')
+
+    parser.add_argument('--max_side', type=int, default=0,
+                    help='Resize frames so the longer side is at most this before upload (0: send originals, 512 matches detail=low)')
+    parser.add_argument('--jpeg_quality', type=int, default=75,
+                    help='JPEG quality of resized frames')
+
     parser.add_argument('--anno_root', type=str, default="./cg_annotations",
                     help='Model name')
+    parser.add_argument('--result_store', type=str, default="./cg_results.db",
+                    help='SQLite results database ("none": write results back into the annotation jsons)')
     parser.add_argument('--image_root', type=str, default="./cg_images",
                     help='Model name')
     parser.add_argument('--sub_root', type=str, default="./cg_subtitles",
@@ -181,17 +434,16 @@ def get_args():
     parser.add_argument('--open_frame_time', type=str2bool, default=True,
                        help='Open frame time parameter (true/false)')
 
-    args = parser.parse_args()
+    return parser
 
+def finalize_args(parser, args):
+    """Validate parsed args and apply the per-task_mode overrides (shared with sweep.py)"""
 
     if args.task_mode in ['eval_open_step_1', 'eval_open_step_2']:
         if not all([args.open_model_name, args.open_model_size, args.open_num_segment]):
             parser.error('eval_open_step_1 and eval_open_step_2 require open_model_name, '
                         'open_model_size, and open_num_segment')
 
-    with open("./run/video_meta_info.json", "r") as f:
-        args.vdict = json.load(f)
-
     if args.task_mode == "clue_acc":
         if args.num_segment > 32:
             args.num_segment = 32
@@ -207,6 +459,22 @@ def get_args():
     if not args.sub:
         args.sub_time = False
 
+    if args.result_store.lower() == "none":
+        args.result_store = None
+
+    if args.request_cache.lower() == "none":
+        args.request_cache = None
+
+    return args
+
+def get_args():
+
+    parser = get_parser()
+    args = finalize_args(parser, parser.parse_args())
+
+    # build_meta 生成的索引按需查询, 没有时读 video_meta_info.json
+    args.vdict = load_video_meta()
+
     return args
 
 
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+def sample_global_batch(max_frames, num_segments):
+    """
+    Uniform frame indices for many videos and many num_segment values in one call.
+    Returns {num_segment: int64 array of shape (len(max_frames), num_segment)}, row i being
+    exactly sample_frames_global_average(max_frames[i], num_segment).
+    """
+    max_frames = np.asarray(max_frames, dtype=np.float64).reshape(-1, 1)
+    num_segments = [int(num_segment) for num_segment in num_segments if num_segment != 0]
+    if not num_segments:
+        return {}
+
+    # 所有 num_segment 拼成一行: idx = 0..n-1, seg_n = n
+    seg_n = np.repeat(num_segments, num_segments).astype(np.float64)
+    idx = np.concatenate([np.arange(num_segment) for num_segment in num_segments]).astype(np.float64)
+
+    seg_size = max_frames / seg_n
+    frame_indices = (seg_size / 2 + np.round(seg_size * idx)).astype(np.int64)
+
+    splits = np.cumsum(num_segments)[:-1]
+    return dict(zip(num_segments, np.split(frame_indices, splits, axis=1)))
+
+def sample_clue_batch(clue_intervals_list, fps_list, num_segments):
+    """
+    Clue-proportional frame indices for many questions and many num_segment values in one call.
+    Returns {num_segment: [list of frame indices per question]}, each list being exactly
+    sample_frames_clue_average(clue_intervals, num_segment, fps).
+    """
+    num_questions = len(clue_intervals_list)
+    if num_questions == 0:
+        # np.split 对空数组仍返回一段, 会多出一个空问题
+        return {num_segment: [] for num_segment in num_segments}
+    clue_counts = np.array([len(clue_intervals) for clue_intervals in clue_intervals_list], dtype=np.int64)
+    num_clues = int(clue_counts.sum())
+
+    question_of_clue = np.repeat(np.arange(num_questions), clue_counts)
+    fps = np.repeat(np.asarray(fps_list, dtype=np.float64), clue_counts)
+    intervals = np.array([interval[:2] for clue_intervals in clue_intervals_list for interval in clue_intervals], dtype=np.float64).reshape(-1, 2)
+
+    # round() 与 np.rint 都是四舍六入五成双
+    starts = np.rint(intervals[:, 0] * fps).astype(np.int64)
+    ends = np.rint(intervals[:, 1] * fps).astype(np.int64)
+    durations = ends - starts
+
+    total_durations = np.zeros(num_questions, dtype=np.int64)
+    np.add.at(total_durations, question_of_clue, durations)
+    clue_totals = total_durations[question_of_clue]
+
+    results = {}
+    for num_segment in num_segments:
+        # 片段总帧数不超过 num_segment 时取全部帧
+        covered = num_segment >= clue_totals
+
+        with np.errstate(all='ignore'):
+            frames_per_clue = np.maximum(1, np.trunc(num_segment * (durations / clue_totals))).astype(np.int64)
+            seg_size = durations / frames_per_clue
+
+        frame_counts = np.where(covered, np.maximum(durations, 0), frames_per_clue)
+
+        clue_of_frame = np.repeat(np.arange(num_clues), frame_counts)
+        clue_offsets = np.cumsum(frame_counts) - frame_counts
+        idx = np.arange(int(frame_counts.sum())) - np.repeat(clue_offsets, frame_counts)
+
+        frame_starts = starts[clue_of_frame]
+        frame_seg_size = seg_size[clue_of_frame]
+        with np.errstate(all='ignore'):
+            spread = np.trunc(frame_starts + frame_seg_size / 2 + frame_seg_size * idx)
+        frame_indices = np.where(covered[clue_of_frame], frame_starts + idx, spread.astype(np.int64))
+
+        question_counts = np.zeros(num_questions, dtype=np.int64)
+        np.add.at(question_counts, question_of_clue, frame_counts)
+        splits = np.cumsum(question_counts)[:-1]
+        results[num_segment] = [frames.tolist() for frames in np.split(frame_indices, splits)]
+
+    return results
+
+def sample_frames_global_average(max_frame, num_segment):
+    frame_indices = []
+    if num_segment != 0.0:
+        frame_indices = sample_global_batch([max_frame], [num_segment])[num_segment][0]
+    return frame_indices
+
+def sample_frames_clue_average(clue_intervals, num_segment, fps):
+    return sample_clue_batch([clue_intervals], [fps], [num_segment])[num_segment][0]
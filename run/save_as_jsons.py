@@ -1,28 +1,48 @@
 import json
 import os
+import hashlib
+import argparse
+import threading
+import concurrent.futures
 
 from tqdm import tqdm
 
+from json_stream import iter_json_items
+
 input_file_path = "./cgbench_mini.json"
 
 output_dir = "./cg_annotations/"
 
-os.makedirs(output_dir, exist_ok=True)
-
-with open(input_file_path, 'r', encoding='utf-8') as f:
-    data = json.load(f)
+# qid -> {"hash", "version"}, 放在 cg_annotations 外面, 不会被当成标注文件
+manifest_path = "./cg_annotations.manifest.json"
 
 keys_to_save = ['qid', 'video_uid', 'question', 'answer', 'choices', 'right_answer', 'clue_intervals']
 
-changed_data = 0
-new_data = 0
+keys_to_compare = ['question', 'answer', 'choices', 'right_answer', 'clue_intervals']
 
-for item in tqdm(data, desc="Processing jsons", unit="file"):
 
-    filtered_item = {key: item[key] for key in keys_to_save}
+def content_hash(item):
+    content = json.dumps([item[key] for key in keys_to_compare], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
 
-    qid = filtered_item['qid']
-    output_file_path = os.path.join(output_dir, f"{qid}.json")
+def write_json_atomic(obj, path, indent=4):
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp_path, path)
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def sync_item(item, output_file_path):
+    """
+    Write one annotation if it is new or its content changed.
+    Returns (status, version) with status in 'new', 'changed', 'unchanged'.
+    """
+    filtered_item = {key: item[key] for key in keys_to_save}
 
     if os.path.exists(output_file_path):
 
@@ -30,24 +50,92 @@ for item in tqdm(data, desc="Processing jsons", unit="file"):
             existing_data = json.load(f)
 
         changes = False
-        for key in ['question', 'answer', 'choices', 'right_answer', 'clue_intervals']:
+        for key in keys_to_compare:
             if existing_data[key] != filtered_item[key]:
                 changes = True
                 break
 
-        if changes:
-            changed_data += 1
-            filtered_item['version'] = existing_data['version'] + 1
-            filtered_item["results"] = existing_data["results"]
-        else:
-            continue
+        if not changes:
+            return 'unchanged', existing_data['version']
+
+        status = 'changed'
+        filtered_item['version'] = existing_data['version'] + 1
+        filtered_item["results"] = existing_data["results"]
     else:
+        status = 'new'
         filtered_item['version'] = 0
         filtered_item['results'] = {}
-        new_data += 1
-
-    with open(output_file_path, 'w', encoding='utf-8') as f:
-        json.dump(filtered_item, f, ensure_ascii=False, indent=4)
 
-
-print(f"changed_data: {changed_data}, new_data: {new_data}")
\ No newline at end of file
+    write_json_atomic(filtered_item, output_file_path)
+    return status, filtered_item['version']
+
+def sync_annotations(data, output_dir, manifest_path, workers=8, full=False):
+    """
+    Sync cg_annotations/<qid>.json with the benchmark items.
+    Items whose content hash matches the manifest (and whose file exists) are skipped without
+    opening their json; the rest are compared and rewritten in parallel.
+    """
+    manifest = {} if full else load_manifest(manifest_path)
+    existing_files = set(os.listdir(output_dir))
+
+    todo = []
+    counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'failed': 0}
+    seen = set()
+    for item in data:
+        qid = str(item['qid'])
+        seen.add(qid)
+        item_hash = content_hash(item)
+        entry = manifest.get(qid)
+        if entry is not None and entry['hash'] == item_hash and f"{qid}.json" in existing_files:
+            counts['unchanged'] += 1
+            continue
+        todo.append((qid, item_hash, item))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(sync_item, item, os.path.join(output_dir, f"{qid}.json")): (qid, item_hash)
+            for qid, item_hash, item in todo
+        }
+        for future in tqdm(concurrent.futures.as_completed(futures), desc="Processing jsons", unit="file", total=len(futures)):
+            qid, item_hash = futures[future]
+            try:
+                status, version = future.result()
+            except Exception as e:
+                print(f"Error writing {qid}: {e}")
+                counts['failed'] += 1
+                continue
+            counts[status] += 1
+            manifest[qid] = {'hash': item_hash, 'version': version}
+
+    removed = sorted(qid for qid in manifest if qid not in seen)
+    for qid in removed:
+        del manifest[qid]
+
+    write_json_atomic(manifest, manifest_path, indent=None)
+
+    counts['removed'] = len(removed)
+    return counts, removed
+
+def main():
+    parser = argparse.ArgumentParser(description="write cgbench_mini.json into cg_annotations/<qid>.json")
+    parser.add_argument('--input', type=str, default=input_file_path)
+    parser.add_argument('--output_dir', type=str, default=output_dir)
+    parser.add_argument('--manifest', type=str, default=manifest_path)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--full', action='store_true', help="ignore the manifest and compare every annotation file")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    data = iter_json_items(args.input, keys_to_save)
+
+    counts, removed = sync_annotations(data, args.output_dir, args.manifest, args.workers, args.full)
+
+    print(f"changed_data: {counts['changed']}, new_data: {counts['new']}, unchanged: {counts['unchanged']}, "
+          f"removed: {counts['removed']}, failed: {counts['failed']}")
+    if removed:
+        # 不删除旧标注, 其中可能还有结果
+        print(f"qids no longer in {args.input} (annotation files kept): {', '.join(removed[:20])}{' ...' if len(removed) > 20 else ''}")
+
+if __name__ == '__main__':
+    main()
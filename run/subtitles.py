@@ -0,0 +1,169 @@
+import os
+import argparse
+import threading
+import os.path as osp
+import concurrent.futures
+
+import numpy as np
+import pysubs2
+from tqdm import tqdm
+
+# 预编译的字幕索引, 与 srt 放在一起: cg_subtitles/<video_uid>.subidx.npz
+CACHE_SUFFIX = '.subidx.npz'
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def milliseconds_to_seconds(milliseconds):
+    return milliseconds / 1000
+
+class SubtitleIndex:
+    """
+    Subtitle events of one video, parsed once. Events are kept in file order; lookups go
+    through start times sorted with a running max of end times, so a query only touches
+    the events that can contain it.
+    """
+
+    def __init__(self, starts, ends, texts=None, blob=None, offsets=None):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        # 文本要么是 list, 要么是 utf-8 blob + offsets (按需解码)
+        self.texts = list(texts) if texts is not None else None
+        self.blob = blob
+        self.offsets = offsets
+
+        self.order = np.argsort(self.starts, kind='stable')
+        self.sorted_starts = self.starts[self.order]
+        self.sorted_ends = self.ends[self.order]
+        self.max_ends = np.maximum.accumulate(self.sorted_ends) if len(self.order) else self.sorted_ends
+
+    @classmethod
+    def from_srt(cls, srt_path):
+        subs = pysubs2.load(srt_path, encoding="utf-8")
+        return cls(
+            [sub.start for sub in subs],
+            [sub.end for sub in subs],
+            [sub.text.replace("\\N", " ") for sub in subs],
+        )
+
+    @classmethod
+    def from_cache(cls, cache_path):
+        with np.load(cache_path) as data:
+            return cls(data['starts'], data['ends'], blob=data['blob'].tobytes(), offsets=data['offsets'])
+
+    def save_cache(self, cache_path):
+        encoded = [self.get_text(event_id).encode('utf-8') for event_id in range(len(self))]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(text) for text in encoded])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        tmp_path = f"{cache_path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, starts=self.starts, ends=self.ends, offsets=offsets, blob=blob)
+        os.replace(tmp_path, cache_path)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def get_text(self, event_id):
+        if self.texts is not None:
+            return self.texts[event_id]
+        return self.blob[self.offsets[event_id]:self.offsets[event_id + 1]].decode('utf-8')
+
+    def query(self, times):
+        """For each time (ms), the ids of events with start < time < end, in file order."""
+        times = np.asarray(times, dtype=np.int64)
+        # 所有 start < t 的事件是 sorted[0:k]
+        counts = np.searchsorted(self.sorted_starts, times, side='left')
+
+        active = []
+        for cur_time, k in zip(times.tolist(), counts.tolist()):
+            event_ids = []
+            j = k - 1
+            while j >= 0 and self.max_ends[j] > cur_time:
+                if self.sorted_ends[j] > cur_time:
+                    event_ids.append(int(self.order[j]))
+                j -= 1
+            event_ids.sort()
+            active.append(event_ids)
+        return active
+
+    def get_line(self, event_id, sub_time=False):
+        sub_text = self.get_text(event_id)
+        if sub_time:
+            start_time = milliseconds_to_seconds(int(self.starts[event_id]))
+            end_time = milliseconds_to_seconds(int(self.ends[event_id]))
+            sub_text = f"[{start_time}, {end_time}] {sub_text}"
+        return sub_text
+
+    def get_lines(self, fps, frame_indices, sub_time=False):
+        """Deduplicated subtitle lines shown at any of the given frames, in frame order."""
+        times = [pysubs2.make_time(fps=fps, frames=frame_index) for frame_index in frame_indices]
+
+        subtitles = []
+        seen = set()
+        for event_ids in self.query(times):
+            for event_id in event_ids:
+                sub_text = self.get_line(event_id, sub_time)
+                if sub_text.strip() and sub_text not in seen:
+                    seen.add(sub_text)
+                    subtitles.append(sub_text)
+        return subtitles
+
+def get_cache_path(srt_path):
+    return osp.splitext(srt_path)[0] + CACHE_SUFFIX
+
+def load_subtitle_index(sub_dir, video_uid):
+    """
+    SubtitleIndex for a video, cached across threads; None if the video has no subtitles.
+    Uses the precompiled .subidx.npz when it is at least as new as the srt.
+    """
+    srt_path = osp.join(sub_dir, f"{video_uid}.srt")
+    try:
+        mtime = os.stat(srt_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    with _indexes_lock:
+        cached = _indexes.get(srt_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    cache_path = get_cache_path(srt_path)
+    if osp.exists(cache_path) and os.stat(cache_path).st_mtime_ns >= mtime:
+        index = SubtitleIndex.from_cache(cache_path)
+    else:
+        index = SubtitleIndex.from_srt(srt_path)
+    with _indexes_lock:
+        _indexes[srt_path] = (mtime, index)
+    return index
+
+def build_cache(srt_path):
+    cache_path = get_cache_path(srt_path)
+    if osp.exists(cache_path) and os.stat(cache_path).st_mtime_ns >= os.stat(srt_path).st_mtime_ns:
+        return False
+    SubtitleIndex.from_srt(srt_path).save_cache(cache_path)
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description="compile cg_subtitles/*.srt into .subidx.npz indexes")
+    parser.add_argument('--sub_root', type=str, default="./cg_subtitles")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    srt_paths = sorted(osp.join(args.sub_root, f) for f in os.listdir(args.sub_root) if f.endswith('.srt'))
+
+    built = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(build_cache, srt_path): srt_path for srt_path in srt_paths}
+        for future in tqdm(concurrent.futures.as_completed(futures), desc="compile", total=len(futures), ncols=100):
+            try:
+                built += future.result()
+            except Exception as e:
+                print(f"Error compiling {futures[future]}: {e}")
+
+    print(f"compiled {built} of {len(srt_paths)} subtitle files")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import itertools
+import logging
+
+import run_api
+import extract_frames
+from utils import get_result_key, get_json_files, str2bool
+from aggregate import parse_result_key
+from video_meta import load_video_meta
+
+# eval_open_step_* 依赖 open 的结果, 仍按顺序用 run_api.py 跑
+SWEEP_TASK_MODES = ['long_acc', 'clue_acc', 'miou', 'open']
+
+
+def parse_args():
+    """
+    Sweep options, plus every other run_api.py option (forwarded unchanged to each config).
+    Returns (sweep_args, run_api argv shared by all configs).
+    """
+    parser = argparse.ArgumentParser(description="run one model over a matrix of configs in one process",
+                                     epilog="any other option is passed to run_api.py for every config", allow_abbrev=False)
+    parser.add_argument('--task_mode', type=str, nargs='+', default=[], choices=SWEEP_TASK_MODES)
+    parser.add_argument('--num_segment', type=int, nargs='+', default=[])
+    parser.add_argument('--sub', type=str2bool, nargs='+', default=[True])
+    parser.add_argument('--sub_time', type=str2bool, nargs='+', default=[True])
+    parser.add_argument('--frame_time', type=str2bool, nargs='+', default=[True])
+    parser.add_argument('--result_keys', type=str, nargs='+', default=[],
+                        help="configs given as result keys, e.g. long_acc_gpt-4o_2024-08-06_32_True_True_True (model size after the last '_')")
+    parser.add_argument('--extract', type=str2bool, default=True,
+                        help="extract the union of the frames of all configs first (skipped with --frame_source video)")
+    parser.add_argument('--bench', type=str, default="./cgbench_mini.json",
+                        help="questions used to plan the interval frames")
+    return parser.parse_known_args()
+
+def get_config_argvs(sweep_args):
+    """One run_api.py argv per config: the task_mode x num_segment x sub x sub_time x frame_time matrix, then the result keys"""
+
+    argvs = []
+    for task_mode, num_segment, sub, sub_time, frame_time in itertools.product(
+            sweep_args.task_mode, sweep_args.num_segment, sweep_args.sub, sweep_args.sub_time, sweep_args.frame_time):
+        argvs.append(['--task_mode', task_mode, '--num_segment', str(num_segment),
+                      '--sub', str(sub), '--sub_time', str(sub_time), '--frame_time', str(frame_time)])
+
+    for result_key in sweep_args.result_keys:
+        p = parse_result_key(result_key)
+        if p is None or p["task_mode"] not in SWEEP_TASK_MODES or '_' not in p["model"]:
+            raise ValueError(f"not a <task_mode>_<model_name>_<model_size>_<num_segment>_<sub>_<sub_time>_<frame_time> key: {result_key}")
+        model_name, model_size = p["model"].rsplit('_', 1)
+        argvs.append(['--task_mode', p["task_mode"], '--model_name', model_name, '--model_size', model_size,
+                      '--num_segment', p["num_segment"], '--sub', p["sub"], '--sub_time', p["sub_time"], '--frame_time', p["frame_time"]])
+
+    return argvs
+
+def get_configs(sweep_args, run_argv):
+    """Parsed run_api args per config, deduplicated on the result key (e.g. clue_acc caps num_segment at 32)"""
+
+    parser = run_api.get_parser()
+    vdict = load_video_meta()
+
+    configs = {}
+    for argv in get_config_argvs(sweep_args):
+        args = run_api.finalize_args(parser, parser.parse_args(run_argv + argv))
+        args.vdict = vdict
+        configs.setdefault(get_result_key(args), args)
+
+    if not configs:
+        parser.error("no configs: give --task_mode and --num_segment, or --result_keys")
+
+    # 同一问题的各配置会同时运行; 写回标注 json 时各自整文件重写, 会互相覆盖结果
+    if next(iter(configs.values())).result_store is None:
+        parser.error("sweep.py needs a result store, --result_store none is not supported")
+
+    return list(configs.values())
+
+def extract_union(configs, bench_path):
+    """Extract the frames of every config in one planned pass per video"""
+
+    args = configs[0]
+    global_num_segments = sorted(set(config.num_segment for config in configs if config.task_mode != 'clue_acc'))
+    interval_num_segments = sorted(set(config.num_segment for config in configs if config.task_mode == 'clue_acc'))
+
+    methods = []
+    if global_num_segments:
+        methods.append('global')
+    if interval_num_segments:
+        methods.append('interval')
+
+    argv = ['--method', *methods, '--num_segment', *map(str, global_num_segments or interval_num_segments)]
+    if interval_num_segments:
+        argv += ['--interval_num_segment', *map(str, interval_num_segments)]
+    if args.max_side > 0:
+        # 上传用的缩小帧也一并写好
+        argv += ['--max_side', str(args.max_side), '--jpeg_quality', str(args.jpeg_quality)]
+
+    print(f"extracting global {global_num_segments}, interval {interval_num_segments}")
+    extract_frames.extract(extract_frames.parse_args(argv), bench_path, args.video_root, args.image_root, args.vdict)
+
+def main():
+
+    sweep_args, run_argv = parse_args()
+    configs = get_configs(sweep_args, run_argv)
+
+    # 运行参数 (线程数, 限速, 缓存大小 ...) 对所有配置相同
+    args = configs[0]
+
+    print(f"{len(configs)} configs:")
+    for config in configs:
+        print(f"  {get_result_key(config)}")
+
+    if sweep_args.extract and args.frame_source == "images":
+        extract_union(configs, sweep_args.bench)
+
+    # 所有配置共用一个进程: 同一个限速 client, 帧/字幕/请求缓存和内存预算
+    store = run_api.setup(args)
+
+    if args.rescore:
+        if store is None:
+            raise ValueError("--rescore needs a result store")
+        for config in configs:
+            run_api.rescore(config, store)
+        store.close()
+        return
+
+    tasks = []
+    for config in configs:
+        json_files = get_json_files(config)
+        print(f"{get_result_key(config)}: {len(json_files)} files to process")
+        tasks.extend((config, json_file) for json_file in json_files)
+
+    # 同一问题的各个配置相邻 (稳定排序, 配置顺序不变), 其帧和字幕在缓存里还热着时就被复用
+    tasks.sort(key=lambda task: task[1])
+
+    logging.info(f"Found {len(tasks)} requests over {len(configs)} configs")
+    print(f"Found {len(tasks)} requests over {len(configs)} configs")
+
+    successful, failed = run_api.dispatch(args, tasks)
+
+    if store is not None:
+        store.close()
+
+    run_api.log_stats(successful, failed)
+
+if __name__ == "__main__":
+    main()
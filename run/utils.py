@@ -1,14 +1,17 @@
-import io
 import os
 import re
 import json
 import base64
-import pysubs2
+import hashlib
 import os.path as osp
 
 import numpy as np
 
-from PIL import Image
+from frame_store import PackedFrame, VideoFrame, ByteLRUCache, get_pack_path, open_frame_pack, read_frame_bytes, get_frame_size
+from video_frames import get_video_frames
+from result_store import get_store, get_step_key, merge_results
+from subtitles import load_subtitle_index, milliseconds_to_seconds
+from sampling import sample_frames_global_average, sample_frames_clue_average
 
 SYS = {
 
@@ -89,6 +92,23 @@ def save_json(anno, json_file):
 
         json.dump(anno, f, indent=4)
 
+def load_anno(json_file):
+    """Load an annotation json, with the results from the result store (if one is open) merged in"""
+
+    anno = load_json(json_file)
+
+    store = get_store()
+    if store is not None:
+        merge_results(anno, store.get_results(anno["qid"]))
+
+    return anno
+
+def get_result_key(args):
+    return f"{args.task_mode}_{args.model_name}_{args.model_size}_{args.num_segment}_{args.sub}_{args.sub_time}_{args.frame_time}"
+
+def get_open_key(args):
+    return f"open_{args.open_model_name}_{args.open_model_size}_{args.open_num_segment}_{args.open_sub}_{args.open_sub_time}_{args.open_frame_time}"
+
 
 def str2bool(v):
     if isinstance(v, bool):
@@ -104,12 +124,13 @@ def merge_intervals(intervals):
     """
     Merge overlapping intervals in a list.
     Assumes each interval is a list [start, end].
+    Returns new [start, end] lists; the input is left untouched.
     """
     if not intervals:
         return []
 
     # Sort intervals by start time
-    intervals.sort(key=lambda x: x[0])
+    intervals = sorted(([interval[0], interval[1]] for interval in intervals), key=lambda x: x[0])
 
     merged = [intervals[0]]
 
@@ -142,82 +163,135 @@ def calculate_intervals_iou(intervals1, intervals2):
     length1 = total_length(merged1)
     length2 = total_length(merged2)
 
-    # Calculate intersection length
+    # Calculate intersection length, sweeping both sorted lists with two pointers
     intersection_length = 0
-    for interval1 in merged1:
-        for interval2 in merged2:
-            intersection_start = max(interval1[0], interval2[0])
-            intersection_end = min(interval1[1], interval2[1])
-            intersection_length += max(0, intersection_end - intersection_start)
+    i, j = 0, 0
+    while i < len(merged1) and j < len(merged2):
+        intersection_start = max(merged1[i][0], merged2[j][0])
+        intersection_end = min(merged1[i][1], merged2[j][1])
+        intersection_length += max(0, intersection_end - intersection_start)
+        if merged1[i][1] < merged2[j][1]:
+            i += 1
+        else:
+            j += 1
     # Calculate union length
     union_length = length1 + length2 - intersection_length
     # IoU is intersection divided by union
     iou = intersection_length / union_length if union_length > 0 else 0
     return iou
 
-def milliseconds_to_seconds(milliseconds):
-    return milliseconds / 1000
+def batch_intervals_iou(predictions, ground_truths):
+    """
+    calculate_intervals_iou for many (prediction, ground truth) pairs at once.
+    Each list is normalised by merge_intervals first (so reversed intervals count exactly as in
+    the scalar version), then lengths and pairwise overlaps are summed per pair in NumPy.
+    """
+    merged1 = [merge_intervals(intervals) for intervals in predictions]
+    merged2 = [merge_intervals(intervals) for intervals in ground_truths]
+    num_pairs = len(merged1)
+
+    def flatten(merged):
+        counts = np.array([len(intervals) for intervals in merged], dtype=np.int64)
+        flat = np.array([interval for intervals in merged for interval in intervals], dtype=np.float64).reshape(-1, 2)
+        return counts, flat[:, 0], flat[:, 1]
+
+    counts1, starts1, ends1 = flatten(merged1)
+    counts2, starts2, ends2 = flatten(merged2)
+    pair1 = np.repeat(np.arange(num_pairs), counts1)
+
+    length1 = np.zeros(num_pairs)
+    length2 = np.zeros(num_pairs)
+    np.add.at(length1, pair1, ends1 - starts1)
+    np.add.at(length2, np.repeat(np.arange(num_pairs), counts2), ends2 - starts2)
+
+    # 合并后的区间有序且互不重叠, 两两重叠之和等于双指针扫描的交集
+    pairs_per_interval = counts2[pair1]
+    idx1 = np.repeat(np.arange(len(starts1)), pairs_per_interval)
+    offsets2 = np.cumsum(counts2) - counts2
+    within = np.arange(int(pairs_per_interval.sum())) - np.repeat(np.cumsum(pairs_per_interval) - pairs_per_interval, pairs_per_interval)
+    idx2 = offsets2[pair1[idx1]] + within
+
+    overlaps = np.maximum(0, np.minimum(ends1[idx1], ends2[idx2]) - np.maximum(starts1[idx1], starts2[idx2]))
+    intersection = np.zeros(num_pairs)
+    np.add.at(intersection, pair1[idx1], overlaps)
+
+    union = length1 + length2 - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union > 0, intersection / union, 0.0)
+
+# 所有线程共享: 同一视频的多个问题会重复发送相同的帧
+base64_cache = ByteLRUCache(1024 * 1024 * 1024)
+
+def get_image_cache_key(image):
+    if isinstance(image, PackedFrame):
+        return (image.pack_path, image.frame_idx, os.stat(image.pack_path).st_mtime_ns)
+    if isinstance(image, VideoFrame):
+        return (image, os.stat(image.video_path).st_mtime_ns)
+    return (image, os.stat(image).st_mtime_ns)
+
+def image_to_base64_str(image):
+    """Base64-encode the stored JPEG bytes as-is (no decode / re-encode)."""
+    key = get_image_cache_key(image)
+    image_base64_str = base64_cache.get(key)
+    if image_base64_str is None:
+        encoded_string = base64.b64encode(read_frame_bytes(image)).decode('utf-8')
+        image_base64_str = f'data:image/jpeg;base64,{encoded_string}'
+        base64_cache.put(key, image_base64_str, len(image_base64_str))
+    return image_base64_str
+
+frame_hash_cache = ByteLRUCache(64 * 1024 * 1024)
+
+def image_content_hash(image):
+    """sha256 of the stored JPEG bytes, cached on (path, mtime)"""
+    key = get_image_cache_key(image)
+    digest = frame_hash_cache.get(key)
+    if digest is None:
+        digest = hashlib.sha256(read_frame_bytes(image)).hexdigest()
+        frame_hash_cache.put(key, digest, 128)
+    return digest
+
+def estimate_payload_bytes(image_paths, text):
+    """Approximate in-memory size of a request body: base64 frames plus the prompt"""
+    return sum((get_frame_size(image) + 2) // 3 * 4 + 32 for image in image_paths) + len(text)
 
 def image_paths_to_base64_str(image_paths):
 
-    image_base64_strs = []
-
-    for image in image_paths:
-        with Image.open(image) as img:
-            byte_stream = io.BytesIO()
-            img.save(byte_stream, format='jpeg')
-            encoded_string = base64.b64encode(byte_stream.getvalue()).decode('utf-8')
-        image_base64_strs.append(f'data:image/jpeg;base64,{encoded_string}')
-
-    return image_base64_strs
+    return [image_to_base64_str(image) for image in image_paths]
 
 def get_list_image_paths(image_dir, frame_indices):
     valid_image_paths = []
     valid_frame_indices = []
+
+    # 优先使用打包的帧文件 (cg_images/<video_uid>.pack), 不在包里的帧再找散装 jpg
+    pack_path = get_pack_path(image_dir)
+    pack = open_frame_pack(pack_path)
+
     for frame_index in frame_indices:
+        if pack is not None and frame_index in pack:
+            valid_image_paths.append(PackedFrame(pack_path, int(frame_index)))
+            valid_frame_indices.append(frame_index)
+            continue
         image_path = osp.join(image_dir, f"{frame_index}.jpg")
         if osp.exists(image_path):
             valid_image_paths.append(image_path)
             valid_frame_indices.append(frame_index)
     return valid_image_paths, valid_frame_indices
 
-def sample_frames_global_average(max_frame, num_segment):
-    frame_indices = []
-    if num_segment != 0.0:
-        seg_size = float(max_frame) / num_segment
-        frame_indices = np.array([
-            int(seg_size / 2 + np.round(seg_size * idx))
-            for idx in range(num_segment)
-        ])
-    return frame_indices
-
-def sample_frames_clue_average(clue_intervals, num_segment, fps):
-    clues_frame_intervals = [(round(interval[0] * fps), round(interval[1] * fps)) for interval in clue_intervals]
-    clue_durations = [interval[1] - interval[0] for interval in clues_frame_intervals]
-    total_duration = sum(clue_durations)
-    if num_segment >= total_duration:
-        return [frame for interval in clues_frame_intervals for frame in range(interval[0], interval[1])]
-    frames_per_clue = [int(num_segment * (duration / total_duration)) for duration in clue_durations]
-    frame_indices = []
-    for i, (interval, num_frames) in enumerate(zip(clues_frame_intervals, frames_per_clue)):
-        num_frames = max(1, num_frames)
-        seg_size = (interval[1] - interval[0]) / num_frames
-        clue_frame_indices = [
-            int(interval[0] + seg_size / 2 + seg_size * idx) for idx in range(num_frames)
-        ]
-        frame_indices.extend(clue_frame_indices)
-    return frame_indices
-
 def load_video_pipeline_args(args, anno):
 
+    frame_source = {}
+    if args.frame_source == "video":
+        frame_source = {"video_path": osp.join(args.video_root, f"{anno['video_uid']}.mp4"), "max_side": args.max_side, "jpeg_quality": args.jpeg_quality}
+
     if args.task_mode in ["long_acc", "miou", "open"]:
-        return load_video_pipeline(osp.join(args.image_root, anno["video_uid"]), args.vdict[anno["video_uid"]]["max_frame"], args.vdict[anno["video_uid"]]["fps"], args.num_segment)
+        return load_video_pipeline(osp.join(args.image_root, anno["video_uid"]), args.vdict[anno["video_uid"]]["max_frame"], args.vdict[anno["video_uid"]]["fps"], args.num_segment, **frame_source)
     elif args.task_mode in ["clue_acc", "eval_open_step_2"]:
-        return load_video_pipeline(osp.join(args.image_root, anno["video_uid"]), None, args.vdict[anno["video_uid"]]["fps"], args.num_segment, anno["clue_intervals"])
+        return load_video_pipeline(osp.join(args.image_root, anno["video_uid"]), None, args.vdict[anno["video_uid"]]["fps"], args.num_segment, anno["clue_intervals"], **frame_source)
     elif args.task_mode == "eval_open_step_1":
         return [], []
 
-def load_video_pipeline(image_dir, max_frame, fps, num_segment, clue_intervals=None):
+def load_video_pipeline(image_dir, max_frame, fps, num_segment, clue_intervals=None, video_path=None, max_side=0, jpeg_quality=75):
+    """Sampled frames from the extracted images, or decoded straight from video_path when given."""
 
     if clue_intervals:
         frame_indices = sample_frames_clue_average(clue_intervals, num_segment, fps)
@@ -228,7 +302,10 @@ def load_video_pipeline(image_dir, max_frame, fps, num_segment, clue_intervals=N
 
     # print(frame_indices)
 
-    image_paths, frame_indices = get_list_image_paths(image_dir, frame_indices)
+    if video_path is not None:
+        image_paths, frame_indices = get_video_frames(video_path, frame_indices, max_side, jpeg_quality)
+    else:
+        image_paths, frame_indices = get_list_image_paths(image_dir, frame_indices)
 
     # print(image_paths, frame_indices)
 
@@ -240,20 +317,9 @@ def get_subtitles(sub_dir, video_uid, fps, frame_indices, sub_time=False):
 
     subtitles = []
 
-    srt_path = osp.join(sub_dir, f"{video_uid}.srt")
-    if osp.exists(srt_path):
-        subs = pysubs2.load(srt_path, encoding="utf-8")
-        for frame_index in frame_indices:
-            cur_time = pysubs2.make_time(fps=fps, frames=frame_index)
-            for sub in subs:
-                if sub.start < cur_time and sub.end > cur_time:
-                    sub_text = sub.text.replace("\\N", " ")
-                    if sub_time:
-                        start_time = milliseconds_to_seconds(sub.start)
-                        end_time = milliseconds_to_seconds(sub.end)
-                        sub_text = f"[{start_time}, {end_time}] {sub_text}"
-                    if sub_text.strip() and sub_text not in subtitles:
-                        subtitles.append(sub_text)
+    index = load_subtitle_index(sub_dir, video_uid)
+    if index is not None:
+        subtitles = index.get_lines(fps, frame_indices, sub_time)
 
     if subtitles:
         subtitles_str = '\n'.join(subtitles)
@@ -267,10 +333,17 @@ def get_frame_times(fps, frame_indices):
     return f"A total of {len(frame_indices)} frames are sampled. Their corresponding timestamps are:\n\n{timestamps}\n\n"
 
 def get_json_files(args):
-    json_files = []
 
     print(args.anno_root)
 
+    store = get_store()
+    if store is not None:
+        changed, removed = store.refresh_annotations(args.anno_root)
+        print(f"annotation index: {changed} updated, {removed} removed")
+        return store.get_pending(args.task_mode, get_result_key(args), get_open_key(args))
+
+    json_files = []
+
     for root, _, files in os.walk(args.anno_root):
         for file in files:
             if not file.endswith('.json'):
@@ -279,10 +352,9 @@ def get_json_files(args):
             json_path = os.path.join(root, file)
 
             try:
-                with open(json_path, 'r', encoding='utf-8') as f:
-                    anno = json.load(f)
+                anno = load_anno(json_path)
 
-                result_key = f"{args.task_mode}_{args.model_name}_{args.model_size}_{args.num_segment}_{args.sub}_{args.sub_time}_{args.frame_time}"
+                result_key = get_result_key(args)
 
                 # print(result_key)
 
@@ -297,7 +369,7 @@ def get_json_files(args):
 
                 # eval_open_step_1
                 elif args.task_mode == 'eval_open_step_1':
-                    open_key = f"open_{args.open_model_name}_{args.open_model_size}_{args.open_num_segment}_{args.open_sub}_{args.open_sub_time}_{args.open_frame_time}"
+                    open_key = get_open_key(args)
 
                     if open_key in anno["results"]:
                         if "step_1" not in anno["results"][open_key]:
@@ -307,7 +379,7 @@ def get_json_files(args):
 
                 # eval_open_step_2
                 elif args.task_mode == 'eval_open_step_2':
-                    open_key = f"open_{args.open_model_name}_{args.open_model_size}_{args.open_num_segment}_{args.open_sub}_{args.open_sub_time}_{args.open_frame_time}"
+                    open_key = get_open_key(args)
 
                     if open_key in anno["results"] and "step_1" in anno["results"][open_key]:
                         if "step_2" not in anno["results"][open_key]:
@@ -350,32 +422,79 @@ def get_prompt(args, anno, frame_indices):
 
     if args.task_mode in ["eval_open_step_1", "eval_open_step_2"]:
 
-        open_key = f"open_{args.open_model_name}_{args.open_model_size}_{args.open_num_segment}_{args.open_sub}_{args.open_sub_time}_{args.open_frame_time}"
+        open_key = get_open_key(args)
         prompt += f"The model's prediction is \'{anno['results'][open_key]['result']}\'\n\n"
 
     return prompt
 
+def save_results(anno, updates, json_file):
+    """Persist {result_key: entry} to the result store, or rewrite the annotation json without one"""
+
+    store = get_store()
+    if store is None:
+        save_json(anno, json_file)
+        return
+
+    for result_key, entry in updates.items():
+        store.put(anno["qid"], result_key, entry["version"], entry["result"])
+
+def get_response_key(args):
+    """Store key a response to this request is saved under"""
+
+    if args.task_mode in ["long_acc", "clue_acc", "miou", "open"]:
+        return get_result_key(args)
+
+    if args.task_mode == "eval_open_step_1":
+        return get_step_key(get_open_key(args), "step_1")
+
+    return get_step_key(get_open_key(args), "step_2")
+
+def get_response_version(args, anno):
+    """Version the result of this request is saved with (see save_result)"""
+
+    if args.task_mode in ["long_acc", "clue_acc", "miou", "open"]:
+        return anno["version"]
+
+    open_key = get_open_key(args)
+    if args.task_mode == "eval_open_step_1":
+        return anno["results"][open_key]["version"]
+
+    return anno["results"][open_key]["step_1"]["version"]
+
+def save_response(args, anno, response, info=None):
+    """Keep the raw model response (with latency and token usage) in the result store"""
+
+    store = get_store()
+    if store is None or response is None:
+        return
+
+    info = info or {}
+    store.put_response(anno["qid"], get_response_key(args), get_response_version(args, anno),
+                       response, info.get("latency"), info.get("usage"))
+
 def save_result(args, anno, result, json_file):
 
+    updates = {}
+
     if args.task_mode in ["long_acc", "clue_acc", "miou", "open"]:
-        result_key = f"{args.task_mode}_{args.model_name}_{args.model_size}_{args.num_segment}_{args.sub}_{args.sub_time}_{args.frame_time}"
+        result_key = get_result_key(args)
         if result_key not in anno["results"]:
             anno["results"][result_key] = {}
         anno["results"][result_key].update({
             "version": anno["version"],
             "result": result
         })
-
-        save_json(anno, json_file)
+        updates[result_key] = anno["results"][result_key]
 
     elif args.task_mode in ["eval_open_step_1"]:
-        open_key = f"open_{args.open_model_name}_{args.open_model_size}_{args.open_num_segment}_{args.open_sub}_{args.open_sub_time}_{args.open_frame_time}"
+        open_key = get_open_key(args)
         if "step_1" not in anno["results"][open_key]:
             anno["results"][open_key]["step_1"] = {}
         anno["results"][open_key]["step_1"].update({
             "version": anno["results"][open_key]["version"],
             "result": result
         })
+        updates[get_step_key(open_key, "step_1")] = anno["results"][open_key]["step_1"]
         if result in [0, 1]:
             if "step_2" not in anno["results"][open_key]:
                 anno["results"][open_key]["step_2"] = {}
@@ -383,32 +502,66 @@ def save_result(args, anno, result, json_file):
                 "version": anno["results"][open_key]["version"],
                 "result": result
             })
-
-        save_json(anno, json_file)
+            updates[get_step_key(open_key, "step_2")] = anno["results"][open_key]["step_2"]
 
     elif args.task_mode in ["eval_open_step_2"]:
-        open_key = f"open_{args.open_model_name}_{args.open_model_size}_{args.open_num_segment}_{args.open_sub}_{args.open_sub_time}_{args.open_frame_time}"
+        open_key = get_open_key(args)
         if "step_2" not in anno["results"][open_key]:
             anno["results"][open_key]["step_2"] = {}
         anno["results"][open_key]["step_2"].update({
             "version": anno["results"][open_key]["step_1"]["version"],
             "result": result
         })
+        updates[get_step_key(open_key, "step_2")] = anno["results"][open_key]["step_2"]
 
-        save_json(anno, json_file)
+    save_results(anno, updates, json_file)
+
+def get_json_content(response):
+
+    json_start = response.find('```json')
+    json_end = response.find('```', json_start + len('```json'))
+    if json_start != -1 and json_end != -1:
+        return response[json_start + len('```json'):json_end].strip()
+    return ""
+
+def parse_miou_result(response):
+    """
+    The predicted intervals of a miou response, as post_process scores them: the json result if
+    calculate_intervals_iou can use it, else the numbers in the response taken in pairs.
+    None if the response has neither.
+    """
+    if not response:
+        return None
+
+    json_content = get_json_content(response)
+    if json_content:
+        try:
+            model_result = json.loads(json_content)["result"]
+            # 与 calculate_intervals_iou 失败的情况一致时才退回正则
+            float(sum(end - start for start, end in merge_intervals(model_result)))
+            # null / 空结果与 [] 一样记 0 分
+            return model_result or []
+        except Exception as e:
+            print(f"Error in parsing JSON: {e}, {json_content}")
+
+    numbers = re.findall(r'-?\d+\.?\d*', response)
+    if len(numbers) % 2 != 0:
+        return None
+    return [(float(numbers[i]), float(numbers[i+1])) for i in range(0, len(numbers), 2)]
 
 def post_process(args, anno, response):
 
     result = None
 
+    if args.task_mode == "miou":
+        model_result = parse_miou_result(response)
+        if model_result is not None:
+            result = calculate_intervals_iou(model_result, anno["clue_intervals"])
+        return result
+
     if response:
 
-        json_start = response.find('```json')
-        json_end = response.find('```', json_start + len('```json'))
-        if json_start != -1 and json_end != -1:
-            json_content = response[json_start + len('```json'):json_end].strip()
-        else:
-            json_content = ""
+        json_content = get_json_content(response)
         if json_content:
             if args.task_mode in ["long_acc", "clue_acc"]:
                 json_content = re.sub(r'(?<=:\s)([A-Za-z_]\w*)', r'"\1"', json_content)
@@ -417,9 +570,6 @@ def post_process(args, anno, response):
                 if args.task_mode in ["long_acc", "clue_acc"]:
                     right_answer = anno["right_answer"]
                     result = 1 if right_answer == model_result else 0
-                elif args.task_mode == "miou":
-                    right_answer = anno["clue_intervals"]
-                    result = calculate_intervals_iou(model_result, right_answer)
                 elif args.task_mode in ["open", "eval_open_step_1", "eval_open_step_2"]:
                     result = model_result
             except Exception as e:
@@ -430,14 +580,6 @@ def post_process(args, anno, response):
                 if matches:
                     right_answer = anno["right_answer"]
                     result = 1 if right_answer in matches else 0
-            elif args.task_mode == "miou":
-                numbers = re.findall(r'-?\d+\.?\d*', response)
-                if len(numbers) % 2 != 0:
-                    result = None
-                else:
-                    right_answer = anno["clue_intervals"]
-                    model_result = [(float(numbers[i]), float(numbers[i+1])) for i in range(0, len(numbers), 2)]
-                    result = calculate_intervals_iou(model_result, right_answer)
             elif args.task_mode == "eval_open_step_1":
                 match = re.search(r'[012]', response)
                 if match:
@@ -0,0 +1,81 @@
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+try:
+    import decord
+except ImportError:
+    decord = None
+
+from frame_store import VideoFrame, ByteLRUCache
+from frame_resize import resize_image, encode_jpeg
+
+# 解码后编码好的 jpeg, 同一视频的多个问题共用
+video_frame_cache = ByteLRUCache(512 * 1024 * 1024)
+
+_local = threading.local()
+
+
+def open_video_reader(video_path):
+    if decord is None:
+        raise ImportError("decord is required to decode frames from videos")
+    return decord.VideoReader(video_path)
+
+def get_video_reader(video_path, max_cached=2):
+    """Reuse VideoReaders within a thread across questions of the same video, instead of reopening the file."""
+    readers = getattr(_local, 'readers', None)
+    if readers is None:
+        readers = _local.readers = OrderedDict()
+    if video_path in readers:
+        readers.move_to_end(video_path)
+        return readers[video_path]
+    vr = open_video_reader(video_path)
+    readers[video_path] = vr
+    while len(readers) > max_cached:
+        readers.popitem(last=False)
+    return vr
+
+def encode_frame(frame, max_side=0, quality=75):
+    image = Image.fromarray(frame)
+    if max_side > 0:
+        image = resize_image(image, max_side)
+    return encode_jpeg(image, quality)
+
+def decode_frames(refs, batch_size=8):
+    """Decode and cache refs of one video, in frame order, batch_size frames per get_batch call."""
+    refs = sorted(refs, key=lambda ref: ref.frame_idx)
+    if not refs:
+        return
+    vr = get_video_reader(refs[0].video_path)
+    for start in range(0, len(refs), batch_size):
+        batch = refs[start:start + batch_size]
+        frames = vr.get_batch([ref.frame_idx for ref in batch]).asnumpy()
+        for ref, frame in zip(batch, frames):
+            data = encode_frame(frame, ref.max_side, ref.quality)
+            video_frame_cache.put(ref, data, len(data))
+
+def get_video_frames(video_path, frame_indices, max_side=0, quality=75):
+    """
+    VideoFrame refs for the sampled frames of a video, decoded up front in one sequential pass
+    (frames already in video_frame_cache are reused). Frames outside the video are dropped.
+    """
+    if not os.path.exists(video_path):
+        return [], []
+
+    num_frames = len(get_video_reader(video_path))
+    frame_indices = [frame_idx for frame_idx in frame_indices if 0 <= frame_idx < num_frames]
+    refs = [VideoFrame(video_path, int(frame_idx), max_side, quality) for frame_idx in frame_indices]
+
+    decode_frames([ref for ref in set(refs) if video_frame_cache.get(ref) is None])
+    return refs, frame_indices
+
+def read_video_frame(ref):
+    data = video_frame_cache.get(ref)
+    if data is None:
+        # 已被淘汰, 单独再解一次
+        vr = get_video_reader(ref.video_path)
+        data = encode_frame(vr.get_batch([ref.frame_idx]).asnumpy()[0], ref.max_side, ref.quality)
+        video_frame_cache.put(ref, data, len(data))
+    return data
@@ -0,0 +1,171 @@
+import os
+import json
+import argparse
+import concurrent.futures
+from collections.abc import Mapping
+
+import numpy as np
+from tqdm import tqdm
+
+try:
+    import decord
+except ImportError:
+    decord = None
+
+VIDEO_META_JSON = './run/video_meta_info.json'
+# 按 video_uid 排序的列存储, 查询时二分, 只取用到的条目
+VIDEO_META_INDEX = './run/video_meta_info.npz'
+
+
+class VideoMetaIndex(Mapping):
+    """
+    Read-only {video_uid: {"duration", "max_frame", "fps"}} over the columns of video_meta_info.npz.
+    Entries are built on access, so only the videos actually used are materialised.
+    """
+
+    def __init__(self, uids, fps, max_frame, durations=None, sizes=None, mtimes=None):
+        self.uids = np.asarray(uids)
+        self.fps = np.asarray(fps, dtype=np.float64)
+        self.max_frame = np.asarray(max_frame, dtype=np.int64)
+        self.durations = self.max_frame / self.fps if durations is None else np.asarray(durations, dtype=np.float64)
+        self.sizes = np.full(len(self.uids), -1, dtype=np.int64) if sizes is None else np.asarray(sizes, dtype=np.int64)
+        self.mtimes = np.full(len(self.uids), -1, dtype=np.int64) if mtimes is None else np.asarray(mtimes, dtype=np.int64)
+
+    @classmethod
+    def load(cls, index_path):
+        with np.load(index_path) as data:
+            durations = data['durations'] if 'durations' in data else None
+            return cls(data['uids'], data['fps'], data['max_frame'], durations, data['sizes'], data['mtimes'])
+
+    def save(self, index_path):
+        tmp_path = f"{index_path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, uids=self.uids, fps=self.fps, max_frame=self.max_frame, durations=self.durations,
+                     sizes=self.sizes, mtimes=self.mtimes)
+        os.replace(tmp_path, index_path)
+
+    def _find(self, video_uid):
+        i = int(np.searchsorted(self.uids, video_uid))
+        if i < len(self.uids) and self.uids[i] == video_uid:
+            return i
+        return None
+
+    def __getitem__(self, video_uid):
+        i = self._find(video_uid)
+        if i is None:
+            raise KeyError(video_uid)
+        return {"duration": float(self.durations[i]), "max_frame": int(self.max_frame[i]), "fps": float(self.fps[i])}
+
+    def __contains__(self, video_uid):
+        return self._find(video_uid) is not None
+
+    def __iter__(self):
+        return iter(self.uids.tolist())
+
+    def __len__(self):
+        return len(self.uids)
+
+def from_entries(entries):
+    """{video_uid: (fps, max_frame, duration, size, mtime_ns)} -> VideoMetaIndex"""
+    uids = sorted(entries)
+    return VideoMetaIndex(np.array(uids, dtype=str), *[[entries[uid][k] for uid in uids] for k in range(5)])
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def load_video_meta(index_path=VIDEO_META_INDEX, json_path=VIDEO_META_JSON):
+    """
+    The indexed video meta if it is at least as new as the hand-maintained json, otherwise the json
+    (edits to the json take effect before the index is rebuilt).
+    """
+    index_mtime = get_mtime(index_path)
+    json_mtime = get_mtime(json_path)
+    if index_mtime is not None and (json_mtime is None or index_mtime >= json_mtime):
+        return VideoMetaIndex.load(index_path)
+    with open(json_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def probe_video(video_path):
+    vr = decord.VideoReader(video_path)
+    fps = float(vr.get_avg_fps())
+    return fps, len(vr), len(vr) / fps
+
+def build_meta(video_root, index_path=VIDEO_META_INDEX, json_path=VIDEO_META_JSON, workers=None):
+    """
+    Index cg_videos_720p/*.mp4 into index_path. Entries of video_meta_info.json are authoritative:
+    they are re-read on every build and override the index (with the current size/mtime of the local
+    file), and only videos missing from the json, or whose file changed after it was indexed, are
+    probed. Entries of videos that are not on this machine are kept.
+    Returns (probed, failed) video_uids.
+    """
+    if decord is None:
+        raise ImportError("decord is required to probe videos")
+
+    entries = {}
+    if os.path.exists(index_path):
+        meta = VideoMetaIndex.load(index_path)
+        for i, uid in enumerate(meta.uids.tolist()):
+            entries[uid] = (float(meta.fps[i]), int(meta.max_frame[i]), float(meta.durations[i]), int(meta.sizes[i]), int(meta.mtimes[i]))
+    json_uids = set()
+    if os.path.exists(json_path):
+        # json 每次都整体并入并覆盖索引里的值 (改过的条目也生效), 其中的视频不探测
+        with open(json_path, 'r', encoding='utf-8') as f:
+            for uid, info in json.load(f).items():
+                stat = entries[uid][3:] if uid in entries else (-1, -1)
+                entries[uid] = (info["fps"], info["max_frame"], info["duration"]) + stat
+                json_uids.add(uid)
+
+    todo = {}
+    for entry in os.scandir(video_root):
+        if not entry.name.endswith('.mp4'):
+            continue
+        uid = os.path.splitext(entry.name)[0]
+        stat = entry.stat()
+        if uid in json_uids:
+            entries[uid] = entries[uid][:3] + (stat.st_size, stat.st_mtime_ns)
+            continue
+        if uid in entries and entries[uid][3:] == (stat.st_size, stat.st_mtime_ns):
+            continue
+        todo[uid] = (entry.path, stat.st_size, stat.st_mtime_ns)
+
+    probed = []
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(probe_video, path): uid for uid, (path, _, _) in todo.items()}
+        for future in tqdm(concurrent.futures.as_completed(futures), desc="probe", total=len(futures), ncols=100):
+            uid = futures[future]
+            try:
+                fps, max_frame, duration = future.result()
+            except Exception as e:
+                print(f"Error probing {uid}: {e}")
+                failed.append(uid)
+                continue
+            entries[uid] = (fps, max_frame, duration) + todo[uid][1:]
+            probed.append(uid)
+
+    from_entries(entries).save(index_path)
+    return probed, failed
+
+def main():
+    parser = argparse.ArgumentParser(description="build run/video_meta_info.npz (fps, max_frame per video_uid) from the videos")
+    parser.add_argument('--video_root', type=str, default="./cg_videos_720p")
+    parser.add_argument('--index_path', type=str, default=VIDEO_META_INDEX)
+    parser.add_argument('--json_path', type=str, default=VIDEO_META_JSON)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--write_json', action='store_true', help="also rewrite video_meta_info.json from the index")
+    args = parser.parse_args()
+
+    probed, failed = build_meta(args.video_root, args.index_path, args.json_path, args.workers)
+
+    meta = VideoMetaIndex.load(args.index_path)
+    if args.write_json:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump({uid: meta[uid] for uid in meta}, f)
+
+    print(f"probed {len(probed)} videos ({len(failed)} failed), {len(meta)} in {args.index_path}")
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,13 @@
+import io
 import os
+import time
+import zlib
+import bisect
+import shutil
 import zipfile
+import argparse
+import threading
+import concurrent.futures
 from tqdm import tqdm
 from huggingface_hub import snapshot_download
 
@@ -18,98 +26,224 @@ def get_chunk_number(filename):
     except:
         return float('inf')
 
-def unzip_hf_zip(pth):
-
-    download_dir = pth
-    target_dir = "."
-
-    if os.path.exists(f"{target_dir}/cg_videos_720p") and os.path.exists(f"{target_dir}/cg_subtitles")\
-            and os.path.exists(f"{target_dir}/cg_clue_videos"):
-        print("all exists")
-        return
-
-    video_zip_files = [
-        os.path.join(download_dir, file) for file in os.listdir(download_dir)
-        if file.endswith('.zip') and file.startswith('video')
-    ]
-
-    video_zip_files = sorted(video_zip_files, key=lambda x: get_chunk_number(os.path.basename(x)))
-
-    videos_temp_zip = os.path.join(download_dir, "videos_merged.zip")
-
-    print("Merging video files ...")
-
-    with open(videos_temp_zip, 'wb') as outfile:
-        for video_zip_file in tqdm(video_zip_files, desc="Merging videos"):
-            with open(video_zip_file, 'rb') as infile:
-                outfile.write(infile.read())
+class MultiPartFile:
+    """
+    Read-only, seekable view of several files as if they were concatenated,
+    so a zip split into video*chunk_N.zip parts can be opened without merging it on disk.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.sizes = [os.path.getsize(path) for path in self.paths]
+        self.offsets = []
+        offset = 0
+        for size in self.sizes:
+            self.offsets.append(offset)
+            offset += size
+        self.size = offset
+        self.pos = 0
+        self.files = [None] * len(self.paths)
+
+    def _get_file(self, part):
+        if self.files[part] is None:
+            self.files[part] = open(self.paths[part], 'rb')
+        return self.files[part]
+
+    def seekable(self):
+        return True
 
-    print("Extracting video files...")
+    def readable(self):
+        return True
 
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        return self.pos
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self.pos
+        n = max(0, min(n, self.size - self.pos))
+
+        chunks = []
+        part = bisect.bisect_right(self.offsets, self.pos) - 1
+        while n > 0:
+            f = self._get_file(part)
+            f.seek(self.pos - self.offsets[part])
+            chunk = f.read(min(n, self.sizes[part] - (self.pos - self.offsets[part])))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self.pos += len(chunk)
+            n -= len(chunk)
+            part += 1
+        return b''.join(chunks)
+
+    def close(self):
+        for f in self.files:
+            if f is not None:
+                f.close()
+        self.files = [None] * len(self.paths)
+
+def get_member_path(target_dir, name):
+    # 去掉绝对路径和 .., 与 ZipFile.extract 一样只解压到 target_dir 下
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+    return os.path.join(target_dir, *parts)
+
+def file_crc32(path, chunk_size=1 << 20):
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
+
+def get_entry_mtime(info):
+    return time.mktime(info.date_time + (0, 0, -1))
+
+def is_extracted(info, path):
+    """
+    An earlier (possibly interrupted) run already extracted this member intact.
+    A file of the right size written no earlier than the entry's timestamp is trusted as is;
+    only an older file of the right size is checked against the CRC.
+    """
     try:
-        with zipfile.ZipFile(videos_temp_zip, 'r') as zip_ref:
-            total_files = len(zip_ref.namelist())
-
-            for file in tqdm(zip_ref.namelist(), desc="Extracting", total=total_files):
-                zip_ref.extract(file, target_dir)
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size != info.file_size:
+        return False
+    # zip 时间戳精度 2 秒
+    if stat.st_mtime >= get_entry_mtime(info) - 2:
+        return True
+    return file_crc32(path) == info.CRC
+
+class ZipReaders:
+    """One ZipFile per thread over the same parts (ZipFile cannot share its read position), closed together."""
+
+    def __init__(self, zip_files):
+        self.zip_files = zip_files
+        self._local = threading.local()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        zip_ref = getattr(self._local, 'zip_ref', None)
+        if zip_ref is None:
+            parts = MultiPartFile(self.zip_files)
+            zip_ref = self._local.zip_ref = zipfile.ZipFile(parts, 'r')
+            with self._lock:
+                self._opened.append((zip_ref, parts))
+        return zip_ref
+
+    def close(self):
+        with self._lock:
+            # ZipFile 不会关闭传入的文件对象, 分卷句柄要单独关
+            for zip_ref, parts in self._opened:
+                zip_ref.close()
+                parts.close()
+            self._opened = []
+
+def extract_member(readers, info, target_dir, chunk_size=1 << 20):
+    path = get_member_path(target_dir, info.filename)
+    if info.is_dir():
+        os.makedirs(path, exist_ok=True)
+        return False
+    if is_extracted(info, path):
+        return False
 
-        print(f"Successfully extracted to {target_dir}")
-    except Exception as e:
-        print(f"Error during extraction: {e}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with readers.get().open(info) as src, open(tmp_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, chunk_size)
+    # 与 unzip 一样保留条目时间, 重跑时凭大小和时间即可跳过
+    entry_mtime = get_entry_mtime(info)
+    os.utime(tmp_path, (entry_mtime, entry_mtime))
+    os.replace(tmp_path, path)
+    return True
+
+def extract_zip_parts(zip_files, target_dir, workers=8, desc="Extracting"):
+    """
+    Extract a zip stored as ordered parts, streaming straight from the parts.
+    Members are extracted in parallel; members already on disk intact (see is_extracted) are skipped.
+    Returns the number of members that failed.
+    """
+    parts = MultiPartFile(zip_files)
+    with zipfile.ZipFile(parts, 'r') as zip_ref:
+        infos = zip_ref.infolist()
+    parts.close()
+
+    # 大文件先解压, 避免最后只剩一个线程
+    infos = sorted(infos, key=lambda info: info.file_size, reverse=True)
+
+    extracted = 0
+    failed = 0
+    readers = ZipReaders(zip_files)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(extract_member, readers, info, target_dir): info for info in infos}
+            for future in tqdm(concurrent.futures.as_completed(futures), desc=desc, total=len(futures)):
+                try:
+                    extracted += future.result()
+                except Exception as e:
+                    print(f"Error extracting {futures[future].filename}: {e}")
+                    failed += 1
     finally:
-        if os.path.exists(videos_temp_zip):
-            os.remove(videos_temp_zip)
-            print("Cleaned up temporary video file")
+        readers.close()
+
+    print(f"Extracted {extracted} of {len(infos)} files to {target_dir}")
+    return failed
 
-    clue_video_zip_files = [
+def get_zip_parts(download_dir, prefix):
+    zip_files = [
         os.path.join(download_dir, file) for file in os.listdir(download_dir)
-        if file.endswith('.zip') and file.startswith('clue_video')
+        if file.endswith('.zip') and file.startswith(prefix)
     ]
+    return sorted(zip_files, key=lambda x: get_chunk_number(os.path.basename(x)))
 
-    clue_video_zip_files = sorted(clue_video_zip_files, key=lambda x: get_chunk_number(os.path.basename(x)))
-
-    clue_videos_temp_zip = os.path.join(download_dir, "clue_videos_merged.zip")
-
-    print("Merging clue video files ...")
-
-    with open(clue_videos_temp_zip, 'wb') as outfile:
-        for clue_video_zip_file in tqdm(clue_video_zip_files, desc="Merging clue_videos"):
-            with open(clue_video_zip_file, 'rb') as infile:
-                outfile.write(infile.read())
-
-    print("Extracting clue video files...")
-
-    try:
-        with zipfile.ZipFile(clue_videos_temp_zip, 'r') as zip_ref:
-            total_files = len(zip_ref.namelist())
-
-            for file in tqdm(zip_ref.namelist(), desc="Extracting", total=total_files):
-                zip_ref.extract(file, target_dir)
+def unzip_hf_zip(pth, workers=8):
 
-        print(f"Successfully extracted to {target_dir}")
-    except Exception as e:
-        print(f"Error during extraction: {e}")
-    finally:
-        if os.path.exists(clue_videos_temp_zip):
-            os.remove(clue_videos_temp_zip)
-            print("Cleaned up temporary clue video file")
-
-    print("Extracting subtitle files ...")
+    download_dir = pth
+    target_dir = "."
 
-    subtitles_zip = os.path.join(download_dir, "subtitles.zip")
+    # 中断后重跑会跳过已完整解压的文件, 所以只有全部完成后才写 done 标记
+    done_flag = os.path.join(target_dir, ".cg_unzip_done")
+    if os.path.exists(done_flag):
+        print("all exists")
+        return
 
-    try:
-        with zipfile.ZipFile(subtitles_zip, 'r') as zip_ref:
-            total_files = len(zip_ref.namelist())
+    groups = [
+        ("video files", get_zip_parts(download_dir, 'video')),
+        ("clue video files", get_zip_parts(download_dir, 'clue_video')),
+        ("subtitle files", [os.path.join(download_dir, "subtitles.zip")]),
+    ]
 
-            for file in tqdm(zip_ref.namelist(), desc="Extracting", total=total_files):
-                zip_ref.extract(file, target_dir)
+    complete = True
+    for name, zip_files in groups:
+        print(f"Extracting {name} ...")
+        try:
+            complete &= extract_zip_parts(zip_files, target_dir, workers, desc=f"Extracting {name}") == 0
+        except Exception as e:
+            print(f"Error during extraction: {e}")
+            complete = False
 
-        print(f"Successfully extracted to {target_dir}")
-    except Exception as e:
-        print(f"Error during extraction: {e}")
+    if complete:
+        with open(done_flag, 'w') as f:
+            f.write("done\n")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=8, help="members extracted in parallel")
+    args = parser.parse_args()
+
     repo_id = "CG-Bench/CG-Bench"
 
     if modelscope_flag_set():
@@ -118,4 +252,4 @@ if __name__ == "__main__":
     else:
         dataset_path = snapshot_download(repo_id=repo_id, repo_type='dataset')
 
-    unzip_hf_zip(dataset_path)
\ No newline at end of file
+    unzip_hf_zip(dataset_path, args.workers)
\ No newline at end of file